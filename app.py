@@ -8,25 +8,40 @@ Author: Bikrum Kahlon
 '''
 
 import os
+import click
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, redirect, url_for, send_file, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response, stream_with_context, g
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-import pandas as pd
 from dbmanager import db
 from dbmanager.schema import connect_db
-from dataops.models import BlobCleaned, InternalUsers, ExternalUsers
-from dataops.blob import unclean_blob, clean_blob_excel
-from dataops.loader import insert_log
-from censuscleaning import load_file, column_map_final, clean_items, remove_dupes
+from dataops.models import BlobCleaned, InternalUsers, ExternalUsers, ProcessingJob
+from dataops.blob import unclean_blob, cleaned_blob_meta, iter_cleaned_blob, ensure_cleaned_excel
+from dataops.audit import insert_log
+from dataops.jobs import enqueue_job, job_status, pending_jobs, start_workers
+from dataops.pipeline import CENSUS_FILE_TYPES
+from dataops.preview import get_preview, preview_page
+from dataops.quality import get_quality
+from dataops.delta import get_delta
+from dataops.mapping import list_mappings, set_mapping, delete_mapping, mapping_dict
+from dataops.members import search_members, member_filter_error, MEMBER_FILTERS
+from dataops.listing import list_cleaned_files
+from dataops.stats import upload_stats
+from dataops.content import dedupe_report, recompress_blobs
+from dataops.archive import archive_blobs, ARCHIVE_BATCH_ROWS
+from dataops.models import MemberUploadStats
+from dataops.whitelist import resolve_role, invalidate_role, find_internal_user, find_external_user, parse_bulk_csv, apply_bulk, BULK_KINDS, BULK_MAX_ROWS
+from dataops.models import normalize_email
+from dataops.migrations import upgrade_schema
+from dataops.metrics import request_seconds, render_metrics, metrics_allowed
 from dragdrop import init_dragdrop
 from authlib.integrations.flask_client import OAuth
 import msal
 import uuid
-import io
+import time
+from urllib.parse import quote
 import threading
-from sftp_watcher import start_observer
 from datetime import datetime, timedelta
-from sqlalchemy import func, text
+from sqlalchemy import text
 
 
 
@@ -52,8 +67,10 @@ AUTHORITY = f"https://login.microsoftonline.com/{TENANT_ID}"
 SCOPE = [os.getenv("SCOPE", "User.Read")]
 
 # Aquire tokens for microsoft
+# Authority discovery responses are kept in _msal_http_cache, so only the first login per process goes out for them
+_msal_http_cache = {}
 def _build_msal_app(cache=None):
-    return msal.ConfidentialClientApplication(CLIENT_ID, authority=AUTHORITY, client_credential=CLIENT_SECRET, token_cache=cache)
+    return msal.ConfidentialClientApplication(CLIENT_ID, authority=AUTHORITY, client_credential=CLIENT_SECRET, token_cache=cache, http_cache=_msal_http_cache)
 redirect_uri = os.getenv('REDIRECT_URI')
 
 # Google oAuth config
@@ -66,14 +83,40 @@ connect_db(app)
 # Created table in database for whitelists
 int_whitelist={'first_name':['Big', 'Joe', 'Test'], 'last_name':['Pizza', 'Smo', 'Test'], 'emails': ["brandon@email.com", "uniononetest@email.com", "idk@yea.com"]}
 ext_whitelist={'first_name':['Bikrum', 'First', 'What'], 'last_name':['Kahlon', 'Last', 'The'], 'emails': ["bikrum@email.com", "iuec@email.com", 'blet@email.com'], 'union': ['Test Union', 'Test Union', 'Test Union']}
-with app.app_context():
-    for first_name, last_name, email in zip(int_whitelist['first_name'], int_whitelist['last_name'], int_whitelist['emails']):
-        if not InternalUsers.query.filter_by(email=email).first():
-            db.session.add(InternalUsers(first_name=first_name, last_name=last_name, email=email))
-    for first_name, last_name, email, union in zip(ext_whitelist['first_name'], ext_whitelist['last_name'], ext_whitelist['emails'], ext_whitelist['union']):
-        if not ExternalUsers.query.filter_by(email=email).first():
-            db.session.add(ExternalUsers(first_name=first_name, last_name=last_name, email=email, union=union))
-    db.session.commit()
+
+# Schema upgrade and whitelist seeding, run once per deploy instead of on every import of the app
+# Called by gunicorn's on_starting hook, `flask --app app init-db` and the dev server below
+def init_db():
+    with app.app_context():
+        upgrade_schema()
+        for first_name, last_name, email in zip(int_whitelist['first_name'], int_whitelist['last_name'], int_whitelist['emails']):
+            if not find_internal_user(email):
+                db.session.add(InternalUsers(first_name=first_name, last_name=last_name, email=email))
+        for first_name, last_name, email, union in zip(ext_whitelist['first_name'], ext_whitelist['last_name'], ext_whitelist['emails'], ext_whitelist['union']):
+            if not find_external_user(email):
+                db.session.add(ExternalUsers(first_name=first_name, last_name=last_name, email=email, union=union))
+        db.session.commit()
+
+@app.cli.command("init-db")
+def init_db_command():
+    init_db()
+    print("Database ready")
+
+# Recompresses stored blobs with STORAGE_CODEC and moves inline blobs into the content store, in small batches
+@app.cli.command("recompress-blobs")
+@click.option("--batch-size", default=20, help="Rows per transaction")
+@click.option("--pause", default=0.0, help="Seconds to wait between batches")
+def recompress_blobs_command(batch_size, pause):
+    report = recompress_blobs(batch_size, pause)
+    print(f"Recompressed {report['content_rows']} content rows: {report['bytes_before']} -> {report['bytes_after']} bytes")
+    print(f"Moved {report['original_rows']} original and {report['cleaned_rows']} cleaned rows ({report['inline_bytes_moved']} bytes) into the content store")
+
+# Moves blobs only used by old (or finished) censuses to the object store, leaving a pointer in blob_content
+@app.cli.command("archive-blobs")
+@click.option("--batch-size", default=ARCHIVE_BATCH_ROWS, help="Rows per transaction")
+@click.option("--limit", type=int, default=None, help="Stop after this many rows")
+def archive_blobs_command(batch_size, limit):
+    archive_blobs(batch_size, limit)
 
 # Flask login setup
 login_manager = LoginManager()
@@ -81,28 +124,36 @@ login_manager.init_app(app)
 login_manager.login_view = 'home'
 
 class User(UserMixin):
-    def __init__(self, email):
+    def __init__(self, email, role=None):
         self.id = email
-        self.role = self.get_role()
+        self.role = role or self.get_role()
     def get_role(self):
-        internal = InternalUsers.query.filter_by(email=self.id).first()
-        if internal:
-            return 'internal'
-        external = ExternalUsers.query.filter_by(email=self.id).first()
-        if external:
-            return external.union
-        return None
+        return resolve_role(self.id)
     def get_id(self):
         return self.id
         
 # Assigns function to decorator, called automatically when @login_required is used
+# Roles come from the whitelist cache, so this costs no queries on most requests
 @login_manager.user_loader
 def load_user(email):
-    if InternalUsers.query.filter_by(email=email).first() or ExternalUsers.query.filter_by(email=email).first():
-        print("load_user called with:", email)
-        return User(email)
+    role = resolve_role(email)
+    if role:
+        return User(email, role)
     return None
 
+# Request latency per route, labelled by the route pattern so ids in the URL don't add series
+# Streamed responses (downloads) are timed up to the first byte
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def observe_latency(response):
+    if 'request_start' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_seconds.observe((route, request.method, str(response.status_code)), time.perf_counter() - g.request_start)
+    return response
+
 
 
 """
@@ -146,14 +197,17 @@ def microsoft_authorized():
         if "id_token_claims" in result:
             email = result["id_token_claims"].get("preferred_username")
             if email:
-                if InternalUsers.query.filter_by(email=email).first() or ExternalUsers.query.filter_by(email=email).first():
-                    user = User(email)
+                role = resolve_role(email)
+                if role:
+                    user = User(normalize_email(email), role)
                     login_user(user)
                     session.permanent = True
+                    insert_log(user.id, 'microsoft', 'login')
                     if user.role == 'internal':
                         return redirect(url_for('inthome'))
                     else:
                         return redirect(url_for('exthome'))
+                insert_log(normalize_email(email), 'microsoft', 'denied login')
         flash("Access denied: unauthorized email", "error")
         return redirect(url_for("home"))
     flash("Access denied: unauthorized email", "error")
@@ -171,14 +225,17 @@ def google_authorized():
     email = user_info.get("email")
 
     if email:
-        if InternalUsers.query.filter_by(email=email).first() or ExternalUsers.query.filter_by(email=email).first():
-            user = User(email)
+        role = resolve_role(email)
+        if role:
+            user = User(normalize_email(email), role)
             login_user(user)
             session.permanent = True
+            insert_log(user.id, 'google', 'login')
             if user.role == 'internal':
                 return redirect(url_for('inthome'))
             else:
                 return redirect(url_for('exthome'))
+        insert_log(normalize_email(email), 'google', 'denied login')
     flash("Access denied: unauthorized email", "error")
     return redirect(url_for("home"))
 
@@ -186,7 +243,7 @@ def google_authorized():
 @app.route("/upload", methods=['GET', 'POST'])
 @login_required
 def upload_file():
-    if not ExternalUsers.query.filter_by(email=current_user.id).first():
+    if current_user.role in (None, 'internal'):
         return redirect(url_for('home'))
     # Gets current user
     label = current_user.role
@@ -196,39 +253,71 @@ def upload_file():
         if not file or file.filename == '':
             return "No file Uploaded"
         
-        # Validate and load file
+        # Unsupported files are turned away here, not stored and left to fail on a job worker
         file_type = file.filename.split('.')[-1].lower()
-        df = load_file(file, file.filename)
-        
-        # Turns the original uploaded file into bytes and uploads as BLOB
-        file.stream.seek(0)
-        file_bytes = file.read()
-        unclean_blob(file.filename, label, current_user.id, file_bytes, file_type)
-        
-        # Column Mapping/Cleaning
-        column_mapped_df = column_map_final(df)
-        column_map_df_cleaned = remove_dupes(clean_items(column_mapped_df))
-        
-        # Converts cleaned file to excel and then into bytes for BLOB storage
-        output = io.BytesIO()
-        column_map_df_cleaned.to_excel(output, index=False, engine='xlsxwriter')
-        test_bytes = output.getvalue()
-        clean_blob_excel(file.filename, label, current_user.id, test_bytes, len(df))
-        return redirect(request.url)
+        if file_type not in CENSUS_FILE_TYPES:
+            return jsonify(success=False, message="Unsupported file type, upload a " + ", ".join(CENSUS_FILE_TYPES) + " file"), 400
+
+        # Stores the original from the upload's spooled stream in parts, large censuses are never read into memory whole
+        original = unclean_blob(file.filename, label, current_user.id, file.stream, file_type)
+        insert_log(current_user.id, file.filename, 'upload')
+
+        # Cleaning runs on the job workers, the client polls /jobs/<id> for progress
+        job = enqueue_job(original)
+        return jsonify({'job_id': job.id, 'status': job.status}), 202
     return render_template("upload.html")
 
+# Processing status of an uploaded census
+@app.route('/jobs/<int:job_id>')
+@login_required
+def get_job(job_id):
+    job = db.session.get(ProcessingJob, job_id)
+    if not job or (current_user.role != 'internal' and job.email != current_user.id):
+        return jsonify(success=False, message="Job not found"), 404
+    return jsonify(job_status(job))
+
+# The current user's queued, running and failed uploads, polled by the external upload page
+@app.route('/jobs')
+@login_required
+def list_jobs():
+    return jsonify({'jobs': pending_jobs(current_user.id)})
+
 # File download route for internal users
 @app.route('/download/<int:file_id>')
 @login_required
 def download_file(file_id):
     if current_user.role != "internal":
         return redirect(url_for('home'))
-    # Get BLOB by id for download
-    file = BlobCleaned.query.get(file_id)
-    if file:
-        insert_log(current_user.id, file.filename, 'download')
-        return send_file(io.BytesIO(file.file_blob), as_attachment=True, download_name=file.filename, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-    return "File not found"
+    # Only metadata is loaded here, the bytes are streamed from MariaDB in chunks
+    ensure_cleaned_excel(file_id)
+    meta = cleaned_blob_meta(file_id)
+    if not meta:
+        return "File not found"
+    size = meta.size or 0
+    etag = meta.content_hash or f"{file_id}-{size}"
+    headers = {
+        'ETag': f'"{etag}"',
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'private, no-cache',
+        'Content-Disposition': f"attachment; filename*=UTF-8''{quote(meta.filename)}"
+    }
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    # Single byte range for resumed downloads, ignored if If-Range names another version
+    start, end, status = 0, size - 1, 200
+    byte_range = request.range
+    if byte_range and len(byte_range.ranges) == 1 and request.if_range.etag in (None, etag):
+        span = byte_range.range_for_length(size)
+        if span is None:
+            return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+        start, end, status = span[0], span[1] - 1, 206
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    headers['Content-Length'] = str(end - start + 1)
+
+    if start == 0:
+        insert_log(current_user.id, meta.filename, 'download')
+    return Response(stream_with_context(iter_cleaned_blob(file_id, start, end, meta=meta)), status=status, headers=headers, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
 
 # For previewing files in internal users
 @app.route('/preview/<int:file_id>')
@@ -236,18 +325,57 @@ def download_file(file_id):
 def preview_file(file_id):
     if current_user.role != "internal":
         return redirect(url_for('home'))
-    file = BlobCleaned.query.get(file_id)
-    if not file:
+    meta = cleaned_blob_meta(file_id)
+    if not meta:
         return "File not found", 404
     try:
-        excel_data = io.BytesIO(file.file_blob)
-        df = pd.read_excel(excel_data).head(10)
+        # Rows come from the stored preview (cached in memory), the workbook is never re-read
+        page = request.args.get('page', 1, type=int)
+        df, page, pages = preview_page(get_preview(file_id), page)
         table = df.to_html(classes='preview_table', index=False)
-        insert_log(current_user.id, file.filename, 'preview')
-        return table
+        if page == 1:
+            insert_log(current_user.id, meta.filename, 'preview')
+        return table, 200, {'X-Preview-Page': str(page), 'X-Preview-Pages': str(pages)}
     except Exception:
         return "File not found", 404
 
+# Data quality report of a cleaned file (invalid counts per field and sample rows)
+@app.route('/api/files/<int:file_id>/quality')
+@login_required
+def file_quality(file_id):
+    if current_user.role != "internal":
+        return jsonify(success=False, message="Not allowed"), 403
+    report = get_quality(file_id)
+    if report is None:
+        return jsonify(success=False, message="No quality report for this file"), 404
+    return jsonify(report)
+
+# What changed since the union's previous census: added, changed and removed members with samples
+@app.route('/api/files/<int:file_id>/delta')
+@login_required
+def file_delta(file_id):
+    if current_user.role != "internal":
+        return jsonify(success=False, message="Not allowed"), 403
+    delta = get_delta(file_id)
+    if delta is None:
+        return jsonify(success=False, message="No earlier census from this union to compare with"), 404
+    return jsonify(delta)
+
+# Member lookup across all censuses for internal users, keyset paged with ?after=<next_after>
+@app.route('/api/members')
+@login_required
+def member_search():
+    if current_user.role != "internal":
+        return jsonify(success=False, message="Not allowed"), 403
+    filters = {name: request.args.get(name, '').strip() for name in MEMBER_FILTERS}
+    error = member_filter_error(filters)
+    if error:
+        return jsonify(success=False, message=error), 400
+    try:
+        return jsonify(search_members(filters, after=request.args.get('after'), limit=request.args.get('limit', 50, type=int)))
+    except ValueError:
+        return jsonify(success=False, message="Bad page cursor"), 400
+
 # For updating the status of the census process
 @app.route('/update-stage/<int:file_id>', methods=['POST'])
 @login_required
@@ -259,6 +387,7 @@ def update_file_stage(file_id):
     file_record = BlobCleaned.query.get_or_404(file_id)
     file_record.status = new_status
     db.session.commit()
+    insert_log(current_user.id, file_record.filename, f'stage {new_status}')
     return jsonify({'success': True, 'status': file_record.status})
 
 # Internal users page (list of cleaned census's from MariaDb)
@@ -267,10 +396,27 @@ def update_file_stage(file_id):
 def inthome():
     if current_user.role != 'internal':
         return redirect(url_for('home'))
-    # Get metadata as dict for listing purposes
-    files = BlobCleaned.query.with_entities(BlobCleaned.id, BlobCleaned.filename, BlobCleaned.union, BlobCleaned.email, BlobCleaned.uploaded_at, BlobCleaned.rowcount, BlobCleaned.status).order_by(BlobCleaned.uploaded_at.desc()).all()
-    files_dict = [{'id': f.id, 'filename': f.filename, 'union': f.union, 'email': f.email, 'upload_date' : f.uploaded_at, 'rowcount': f.rowcount, 'status': f.status} for f in files]
-    return render_template("inthome.html", files=files_dict)
+    # Rows are fetched page by page from /api/files by viewmode.js
+    return render_template("inthome.html")
+
+# Paged listing of cleaned files for the internal page, ?next=<cursor> continues from the last page
+@app.route("/api/files")
+@login_required
+def list_files():
+    if current_user.role != 'internal':
+        return jsonify(success=False, message="Not allowed"), 403
+    try:
+        return jsonify(list_cleaned_files(
+            union=request.args.get('union', '').strip(),
+            email=request.args.get('email', '').strip(),
+            filename=request.args.get('filename', '').strip(),
+            sort=request.args.get('sort', 'uploaded_at'),
+            order=request.args.get('order', 'desc'),
+            after=request.args.get('next'),
+            limit=request.args.get('limit', 10, type=int)
+        ))
+    except ValueError:
+        return jsonify(success=False, message="Bad page cursor"), 400
 
 # For adding admins
 @app.route("/add_admin", methods=["POST"])
@@ -279,13 +425,18 @@ def add_admin():
     if current_user.role != 'internal':
         return redirect(url_for('home.html'))
     data = request.get_json()
-    if InternalUsers.query.filter_by(email=data['email']).first():
+    data['email'] = normalize_email(data.get('email'))
+    if not data['email']:
+        return jsonify(success=False, message="Missing email"), 400
+    if find_internal_user(data['email']):
         return jsonify(success=False, message="Email already exists"), 400
     if '@unionone.com' not in data['email']:
         return jsonify(success=False, message="Email must end in @unionone.com"), 400
     new = InternalUsers(first_name=data['first_name'], last_name=data['last_name'], email=data['email'], uploaded_at=datetime.now())
     db.session.add(new)
     db.session.commit()
+    invalidate_role(data['email'])
+    insert_log(current_user.id, data['email'], 'add admin')
     return jsonify({**data, "upload_date": new.uploaded_at.strftime('%Y-%m-%d %H:%M')})
 
 # For editing admins
@@ -299,17 +450,22 @@ def edit_admin():
     updated_email = data.get("email")
     if not original_email:
         return jsonify(success=False, message="Missing original email")
-    email_clean = original_email.strip().lower()
-    user = InternalUsers.query.filter(func.lower(func.trim(InternalUsers.email)) == email_clean).first()
-    if original_email.strip().lower() != updated_email.strip().lower():
-        bad = InternalUsers.query.filter(func.lower(func.trim(InternalUsers.email)) == updated_email.strip().lower()).first()
+    # A blank email would be saved as "" and lock the user out
+    if not normalize_email(updated_email):
+        return jsonify(success=False, message="Missing email"), 400
+    user = find_internal_user(original_email)
+    if normalize_email(original_email) != normalize_email(updated_email):
+        bad = find_internal_user(updated_email)
         if bad:
             return jsonify(success=False, message="Email already exists"), 400
     if user:
         user.first_name = data.get("first_name", user.first_name)
         user.last_name = data.get("last_name", user.last_name)
+        previous_email = user.email
         user.email = updated_email 
         db.session.commit()
+        invalidate_role(previous_email, updated_email)
+        insert_log(current_user.id, user.email if user.email == previous_email else f"{previous_email} -> {user.email}", 'edit admin')
         return jsonify(success=True)
     else:
         return jsonify(success=False, message="User not found")
@@ -324,11 +480,13 @@ def delete_admin():
     original_email = data.get("original_email", data.get("email"))
     if not original_email:
         return jsonify(success=False, message="Missing email")
-    email_clean = original_email.strip().lower()
-    user = InternalUsers.query.filter(func.lower(func.trim(InternalUsers.email)) == email_clean).first()
+    user = find_internal_user(original_email)
     if user:
+        deleted_email = user.email
         db.session.delete(user)
         db.session.commit()
+        invalidate_role(deleted_email)
+        insert_log(current_user.id, deleted_email, 'delete admin')
         return jsonify(success=True)
     else:
         return jsonify(success=False, message="User not found")
@@ -340,11 +498,16 @@ def add_union():
     if current_user.role != 'internal':
         return redirect(url_for('home.html'))
     data = request.get_json()
-    if ExternalUsers.query.filter_by(email=data['email']).first():
+    data['email'] = normalize_email(data.get('email'))
+    if not data['email']:
+        return jsonify(success=False, message="Missing email"), 400
+    if find_external_user(data['email']):
         return jsonify(success=False, message="Email already exists"), 400
     new = ExternalUsers(first_name=data['first_name'], last_name=data['last_name'], email=data['email'], union=data['union'], uploaded_at=datetime.now())
     db.session.add(new)
     db.session.commit()
+    invalidate_role(data['email'])
+    insert_log(current_user.id, data['email'], 'add union member')
     return jsonify({**data, "upload_date": new.uploaded_at.strftime('%Y-%m-%d %H:%M')})
 
 # For editing union members
@@ -358,18 +521,23 @@ def edit_union():
     updated_email = data.get("email")
     if not original_email:
         return jsonify(success=False, message="Missing original email")
-    email_clean = original_email.strip().lower()
-    user = ExternalUsers.query.filter(func.lower(func.trim(ExternalUsers.email)) == email_clean).first()
-    if original_email.strip().lower() != updated_email.strip().lower():
-        bad = ExternalUsers.query.filter(func.lower(func.trim(ExternalUsers.email)) == updated_email.strip().lower()).first()
+    # A blank email would be saved as "" and lock the user out
+    if not normalize_email(updated_email):
+        return jsonify(success=False, message="Missing email"), 400
+    user = find_external_user(original_email)
+    if normalize_email(original_email) != normalize_email(updated_email):
+        bad = find_external_user(updated_email)
         if bad:
             return jsonify(success=False, message="Email already exists"), 400
     if user:
         user.first_name = data.get("first_name", user.first_name)
         user.last_name = data.get("last_name", user.last_name)
+        previous_email = user.email
         user.email = updated_email 
         user.union = data.get("union", user.union)
         db.session.commit()
+        invalidate_role(previous_email, updated_email)
+        insert_log(current_user.id, user.email if user.email == previous_email else f"{previous_email} -> {user.email}", 'edit union member')
         return jsonify(success=True)
     else:
         return jsonify(success=False, message="User not found")
@@ -384,15 +552,51 @@ def delete_union():
     original_email = data.get("original_email", data.get("email"))
     if not original_email:
         return jsonify(success=False, message="Missing email")
-    email_clean = original_email.strip().lower()
-    user = ExternalUsers.query.filter(func.lower(func.trim(ExternalUsers.email)) == email_clean).first()
+    user = find_external_user(original_email)
     if user:
+        deleted_email = user.email
         db.session.delete(user)
         db.session.commit()
+        invalidate_role(deleted_email)
+        insert_log(current_user.id, deleted_email, 'delete union member')
         return jsonify(success=True)
     else:
         return jsonify(success=False, message="User not found")
 
+# Bulk admin / union member changes: /bulk/admins or /bulk/union-members
+# Takes a JSON list of rows (or {"rows": [...]}) or a CSV with op, email, original_email, first_name, last_name, union
+# Nothing is applied unless every row is valid, ?dry_run=1 only returns the per-row report
+@app.route("/bulk/<kind>", methods=["POST"])
+@login_required
+def bulk_members(kind):
+    if current_user.role != 'internal':
+        return jsonify(success=False, message="Not allowed"), 403
+    kind = kind.replace('-', '_')
+    if kind not in BULK_KINDS:
+        return jsonify(success=False, message="Unknown list"), 404
+    try:
+        if 'file' in request.files:
+            rows = parse_bulk_csv(request.files['file'].read().decode('utf-8-sig'))
+        elif request.mimetype == 'text/csv':
+            rows = parse_bulk_csv(request.get_data().decode('utf-8-sig'))
+        else:
+            data = request.get_json(silent=True)
+            rows = data.get('rows') if isinstance(data, dict) else data
+    except UnicodeDecodeError:
+        return jsonify(success=False, message="CSV must be UTF-8"), 400
+    if not isinstance(rows, list) or not rows or not all(isinstance(row, dict) for row in rows):
+        return jsonify(success=False, message="Send a JSON list of rows or a CSV file"), 400
+    if len(rows) > BULK_MAX_ROWS:
+        return jsonify(success=False, message=f"At most {BULK_MAX_ROWS} rows per request"), 400
+
+    result = apply_bulk(kind, rows, dry_run=request.args.get('dry_run', '').lower() in ('1', 'true'))
+    label = 'admin' if kind == 'admins' else 'union member'
+    if result['applied']:
+        for entry in result['rows']:
+            target = entry['email'] if entry['email'] == entry['original_email'] or not entry['original_email'] else f"{entry['original_email']} -> {entry['email']}"
+            insert_log(current_user.id, target, f"bulk {entry['op']} {label}")
+    return jsonify(result), 200 if result['success'] else 400
+
 # Admin page (for making changes >:3)
 @app.route("/admin")
 @login_required
@@ -403,15 +607,70 @@ def admin():
     admins_files = InternalUsers.query.with_entities(InternalUsers.first_name, InternalUsers.last_name, InternalUsers.email, InternalUsers.uploaded_at).order_by(InternalUsers.uploaded_at.desc()).all()
     admins = [{'first_name': f.first_name, 'last_name': f.last_name, 'email': f.email, 'upload_date': f.uploaded_at} for f in admins_files]
     
-    last_uploads_raw = (db.session.query(BlobCleaned.email,func.max(BlobCleaned.uploaded_at).label("last_upload")).group_by(BlobCleaned.email).all())
-    last_uploads = {email: str(upload_date)[:10] if upload_date else None for email, upload_date in last_uploads_raw}
-    union_members_files = ExternalUsers.query.with_entities(ExternalUsers.first_name, ExternalUsers.last_name, ExternalUsers.email, ExternalUsers.union, ExternalUsers.uploaded_at).order_by(ExternalUsers.uploaded_at.desc()).all()
-    union_members = [{'union': f.union, 'first_name': f.first_name, 'last_name': f.last_name, 'email': f.email, 'upload_date': f.uploaded_at, 'recent_upload': last_uploads.get(f.email) or " "} for f in union_members_files]
+    # Last upload comes from the maintained stats table, one row per member instead of scanning blob_cleaned
+    union_members_files = ExternalUsers.query.outerjoin(MemberUploadStats, MemberUploadStats.email == ExternalUsers.email).with_entities(ExternalUsers.first_name, ExternalUsers.last_name, ExternalUsers.email, ExternalUsers.union, ExternalUsers.uploaded_at, MemberUploadStats.last_upload).order_by(ExternalUsers.uploaded_at.desc()).all()
+    union_members = [{'union': f.union, 'first_name': f.first_name, 'last_name': f.last_name, 'email': f.email, 'upload_date': f.uploaded_at, 'recent_upload': str(f.last_upload)[:10] if f.last_upload else " "} for f in union_members_files]
 
-    sftp_files = BlobCleaned.query.filter(BlobCleaned.email == 'sftp').order_by(BlobCleaned.uploaded_at.desc()).all()
+    sftp_files = BlobCleaned.query.with_entities(BlobCleaned.id, BlobCleaned.filename, BlobCleaned.union, BlobCleaned.email, BlobCleaned.uploaded_at, BlobCleaned.rowcount).filter(BlobCleaned.email == 'sftp', BlobCleaned.loaded.is_(True)).order_by(BlobCleaned.uploaded_at.desc()).all()
     sftp_users = [{'id': f.id, 'filename': f.filename, 'union': f.union, 'email': f.email, 'upload_date' : f.uploaded_at, 'rowcount': f.rowcount} for f in sftp_files]
     return(render_template('admin.html', union_members=union_members, admins=admins, sftp_users=sftp_users))
 
+# Per-union and per-member upload totals for reporting
+@app.route("/api/upload-stats")
+@login_required
+def get_upload_stats():
+    if current_user.role != 'internal':
+        return jsonify(success=False, message="Not allowed"), 403
+    return jsonify(upload_stats())
+
+# How much storage and cleaning the content hash dedupe has saved
+@app.route("/api/dedupe-report")
+@login_required
+def get_dedupe_report():
+    if current_user.role != 'internal':
+        return jsonify(success=False, message="Not allowed"), 403
+    return jsonify(dedupe_report())
+
+# Stored column mappings per union and header layout, with hits and the mapping time they saved (?union= to filter)
+@app.route("/api/column-mappings")
+@login_required
+def get_column_mappings():
+    if current_user.role != 'internal':
+        return jsonify(success=False, message="Not allowed"), 403
+    return jsonify(list_mappings(request.args.get('union', '').strip() or None))
+
+# Admin override of a stored mapping: {"mapping": {"standard column": "raw header" or null}}
+@app.route("/api/column-mappings/<int:mapping_id>", methods=["PUT"])
+@login_required
+def edit_column_mapping(mapping_id):
+    if current_user.role != 'internal':
+        return jsonify(success=False, message="Not allowed"), 403
+    data = request.get_json(silent=True) or {}
+    row, error = set_mapping(mapping_id, data.get('mapping'), current_user.id)
+    if error:
+        return jsonify(success=False, message=error), 404 if error == "Mapping not found" else 400
+    insert_log(current_user.id, f"{row.union} column mapping {row.id}", 'edit column mapping')
+    return jsonify(mapping_dict(row))
+
+# Forgets a stored mapping so the union's next census with that header row is mapped from scratch
+@app.route("/api/column-mappings/<int:mapping_id>", methods=["DELETE"])
+@login_required
+def remove_column_mapping(mapping_id):
+    if current_user.role != 'internal':
+        return jsonify(success=False, message="Not allowed"), 403
+    deleted = delete_mapping(mapping_id)
+    if deleted is None:
+        return jsonify(success=False, message="Mapping not found"), 404
+    insert_log(current_user.id, f"{deleted['union']} column mapping {mapping_id}", 'delete column mapping')
+    return jsonify(success=True)
+
+# Prometheus scrape endpoint, needs METRICS_TOKEN as a bearer token and is closed without one unless METRICS_PUBLIC=1
+@app.route("/metrics")
+def metrics():
+    if not metrics_allowed(request.headers.get('Authorization')):
+        return Response(status=401)
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 # External users page (drag and drop census upload)
 @app.route("/external")
 @login_required
@@ -419,24 +678,30 @@ def exthome():
     if current_user.role == 'internal':
         return redirect(url_for('home'))
     uploads = BlobCleaned.query \
-        .filter_by(email=current_user.id) \
+        .filter_by(email=current_user.id, loaded=True) \
         .order_by(BlobCleaned.uploaded_at.desc()) \
         .with_entities(BlobCleaned.filename, BlobCleaned.uploaded_at) \
         .all()
-    current_union = ExternalUsers.query.filter(ExternalUsers.email == current_user.id).first()
+    current_union = {'union': current_user.role}
     uploads_list = [{'filename': u.filename, 'uploaded_at': u.uploaded_at.strftime('%Y-%m-%d %H:%M')} for u in uploads]
-    return render_template("exthome.html", uploads=uploads_list, current_union=current_union)
+    return render_template("exthome.html", uploads=uploads_list, jobs=pending_jobs(current_user.id), current_union=current_union)
 
 # Logout process for current user
 @app.route('/logout')
 @login_required
 def logout():
+    insert_log(current_user.id, '', 'logout')
     logout_user()
     session.clear()
     return redirect(url_for('home'))
 
 
+# Development server with the watcher and job workers in the same process
+# Production runs `gunicorn -c gunicorn.conf.py app:app` and `python sftp_watcher.py` as separate processes
 if __name__ == "__main__":
+    from sftp_watcher import start_observer
+    init_db()
     watcher_thread = threading.Thread(target=start_observer, daemon=True)
     watcher_thread.start()
+    start_workers(app)
     app.run(debug=False, host='0.0.0.0', use_reloader=False)
\ No newline at end of file
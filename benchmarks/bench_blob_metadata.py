@@ -0,0 +1,80 @@
+'''
+Benchmark for metadata queries against the BLOB tables as the number of stored censuses grows.
+
+Runs the admin page's queries plus entity loads (query.all() / session.get) against an SQLite
+stand-in, once with file_blob deferred (current models) and once with it undeferred (the old
+behaviour). With deferral, time and peak memory should stay flat as the table grows.
+
+Usage: python benchmarks/bench_blob_metadata.py --sizes 50 200 800 --blob-kb 256
+'''
+
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import func
+from sqlalchemy.orm import undefer_group
+from dbmanager import db
+from dataops.models import BlobCleaned, BlobOriginal, InternalUsers, ExternalUsers
+
+
+def make_app(uri):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    db.init_app(app)
+    return app
+
+# Adds rows until both BLOB tables hold `total` censuses with `blob_kb` KB payloads
+def fill(total, blob_kb):
+    payload = os.urandom(blob_kb * 1024)
+    have = BlobCleaned.query.count()
+    for i in range(have, total):
+        email = 'sftp' if i % 4 == 0 else f"member{i % 50}@union.com"
+        db.session.add(BlobOriginal(filename=f"census_{i}.csv", union=f"Union {i % 10}", email=email, file_blob=payload, file_type="csv", uploaded_at=datetime.now()))
+        db.session.add(BlobCleaned(filename=f"census_{i}.xlsx", union=f"Union {i % 10}", email=email, file_blob=payload, file_type="xlsx", uploaded_at=datetime.now(), rowcount="1000", status="0", file_size=len(payload)))
+    db.session.commit()
+
+# Same queries the admin page and preview/update-stage routes run
+def metadata_queries(undeferred):
+    options = [undefer_group('payload')] if undeferred else []
+    InternalUsers.query.with_entities(InternalUsers.email, InternalUsers.uploaded_at).all()
+    ExternalUsers.query.with_entities(ExternalUsers.email, ExternalUsers.uploaded_at).all()
+    db.session.query(BlobCleaned.email, func.max(BlobCleaned.uploaded_at)).group_by(BlobCleaned.email).all()
+    BlobCleaned.query.options(*options).filter(BlobCleaned.email == 'sftp').all()
+    BlobOriginal.query.options(*options).all()
+    db.session.get(BlobCleaned, 1, options=options)
+
+def measure(undeferred):
+    db.session.expunge_all()
+    tracemalloc.start()
+    start = time.perf_counter()
+    metadata_queries(undeferred)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    db.session.expunge_all()
+    return elapsed, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 200, 800])
+    parser.add_argument("--blob-kb", type=int, default=256)
+    parser.add_argument("--db", default=os.getenv("BENCH_DATABASE_URI", "sqlite://"))
+    args = parser.parse_args()
+
+    app = make_app(args.db)
+    with app.app_context():
+        db.create_all()
+        print(f"{'censuses':>10} {'deferred ms':>12} {'deferred MB':>12} {'undeferred ms':>14} {'undeferred MB':>14}")
+        for size in args.sizes:
+            fill(size, args.blob_kb)
+            deferred_time, deferred_peak = measure(False)
+            full_time, full_peak = measure(True)
+            print(f"{size:>10} {deferred_time * 1000:>12.1f} {deferred_peak / 2**20:>12.2f} {full_time * 1000:>14.1f} {full_peak / 2**20:>14.2f}")
@@ -0,0 +1,269 @@
+'''
+End to end benchmark for the ingestion paths and the portal routes, meant to be run on each commit
+and compared. The real app is imported with its database pointed at an SQLite (or MariaDB) stand-in,
+OAuth is skipped by writing the Flask-Login session directly.
+
+- ingest: synthetic csv/xlsx/txt censuses (messy headers, duplicates) through POST /upload plus the
+  job that cleans it, and through sftp_watcher.process_file()
+- routes: /internal/files, /api/files, /admin, /preview and /download as BlobCleaned grows
+
+Every case records seconds, rows/s (ingest) or requests/s (routes) and peak RSS, and the whole run
+is written as JSON. --compare prints the ratio against an earlier report. Each case runs in its own
+interpreter (--case), so its peak RSS isn't the high-water mark left behind by the cases before it.
+
+Usage: python benchmarks/bench_portal.py --rows 1000 10000 100000 --files 100 1000 5000 --out before.json
+       python benchmarks/bench_portal.py --compare before.json --out after.json
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import psutil
+from synthetic import messy_census_frame
+
+INTERNAL_EMAIL = "brandon@email.com"
+EXTERNAL_EMAIL = "bikrum@email.com"
+EXTERNAL_UNION = "Test Union"
+
+
+# Points the app at the benchmark database before app.py connects to MariaDB
+def load_portal(uri):
+    import dbmanager.schema
+    from dbmanager import db
+
+    def connect_bench_db(app):
+        app.config['SQLALCHEMY_DATABASE_URI'] = uri
+        db.init_app(app)
+    dbmanager.schema.connect_db = connect_bench_db
+    import app as portal
+    portal.init_db()
+    portal.app.config['TESTING'] = True
+    return portal
+
+# Highest RSS seen while the block runs, sampled from a background thread
+class PeakRss:
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+
+    def _sample(self):
+        process = psutil.Process()
+        while not self._done.is_set():
+            self.peak = max(self.peak, process.memory_info().rss)
+            self._done.wait(self.interval)
+
+    def __enter__(self):
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._done.set()
+        self._thread.join()
+        self.peak = max(self.peak, psutil.Process().memory_info().rss)
+
+def measure(fn):
+    with PeakRss() as rss:
+        start = time.perf_counter()
+        fn()
+        seconds = time.perf_counter() - start
+    return seconds, rss.peak
+
+# Runs one case in a fresh interpreter and returns its seconds, peak RSS and RSS before the case started
+def run_isolated(uri, case):
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), '--db', uri, '--case', json.dumps(case)],
+                         stdout=subprocess.PIPE, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+# The --case side of run_isolated, the app and the database are set up before the starting RSS is taken
+def run_case(uri, case):
+    portal = load_portal(uri)
+    client = portal.app.test_client()
+    if case['kind'] == 'ingest':
+        login(client, EXTERNAL_EMAIL)
+        # Clear the content store links so each run cleans instead of reusing an earlier result
+        with portal.app.app_context():
+            forget_cleaned(portal)
+        run = (lambda: bench_upload(portal, client, case['file'])) if case['path'] == 'upload' else (lambda: bench_sftp(case['file']))
+    else:
+        login(client, INTERNAL_EMAIL)
+        run = lambda: measure(lambda: hit_route(client, case['url'], case['repeat']))
+    start_rss = psutil.Process().memory_info().rss
+    seconds, peak = run()
+    return {'seconds': seconds, 'peak_rss': peak, 'start_rss': start_rss}
+
+# Logs the test client in as the given email without going through Microsoft/Google
+def login(client, email):
+    with client.session_transaction() as sess:
+        sess['_user_id'] = email
+        sess['_fresh'] = True
+
+# Writes the synthetic census once per (rows, format) into the folder the watcher would see
+def write_census(folder, rows, file_type):
+    path = os.path.join(folder, EXTERNAL_UNION, f"census_{rows}.{file_type}")
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df = messy_census_frame(rows, dupe_rate=0.05, seed=rows)
+    if file_type == 'xlsx':
+        df.to_excel(path, index=False, engine='xlsxwriter')
+    elif file_type == 'txt':
+        df.to_csv(path, index=False, sep='\t')
+    else:
+        df.to_csv(path, index=False)
+    return path
+
+def bench_upload(portal, client, path):
+    from dataops.jobs import run_job
+
+    def upload():
+        with open(path, 'rb') as f:
+            response = client.post('/upload', data={'file': (f, os.path.basename(path))}, content_type='multipart/form-data')
+        assert response.status_code == 202, response.status_code
+        with portal.app.app_context():
+            run_job(response.get_json()['job_id'])
+    return measure(upload)
+
+def bench_sftp(path):
+    from sftp_watcher import process_file
+    # Unique email per run so the already-processed check doesn't short circuit it
+    return measure(lambda: process_file(path, email=f"bench-{time.time_ns()}"))
+
+def ingest(uri, folder, rows_list, file_types):
+    results = []
+    for rows in rows_list:
+        for file_type in file_types:
+            if file_type == 'xlsx' and rows > 1048575:
+                continue
+            path = write_census(folder, rows, file_type)
+            size = os.path.getsize(path)
+            for name in ('upload', 'process_file'):
+                case = run_isolated(uri, {'kind': 'ingest', 'path': name, 'file': path})
+                seconds, peak, growth = case['seconds'], case['peak_rss'], case['peak_rss'] - case['start_rss']
+                results.append({'path': name, 'format': file_type, 'rows': rows, 'bytes': size, 'seconds': round(seconds, 4),
+                                'rows_per_second': round(rows / seconds), 'mb_per_second': round(size / 2**20 / seconds, 2),
+                                'peak_rss_mb': round(peak / 2**20, 1), 'rss_growth_mb': round(growth / 2**20, 1)})
+                print(f"{name:>12} {file_type:>4} {rows:>9} rows {seconds:>8.2f}s {rows / seconds:>10.0f} rows/s {peak / 2**20:>8.1f} MB (+{growth / 2**20:.1f})")
+    return results
+
+def forget_cleaned(portal):
+    from dbmanager import db
+    from dataops.models import BlobCleaned
+    BlobCleaned.query.update({'source_hash': None}, synchronize_session=False)
+    db.session.commit()
+
+# Copies existing cleaned rows (metadata and content links only) until the table holds `total`
+def fill_cleaned(portal, total):
+    from dbmanager import db
+    from dataops.models import BlobCleaned, ExternalUsers
+    from dataops.content import add_content_ref
+    template = BlobCleaned.query.filter(BlobCleaned.parquet_hash.isnot(None)).order_by(BlobCleaned.id).first()
+    have = BlobCleaned.query.count()
+    for i in range(have, total):
+        email = 'sftp' if i % 4 == 0 else f"member{i % 200}@union.com"
+        db.session.add(BlobCleaned(filename=f"census_{i}.xlsx", union=f"Union {i % 20}", email=email, file_type="xlsx", uploaded_at=datetime.now(),
+                                   rowcount=template.rowcount, status="0", parquet_hash=template.parquet_hash, reused=True))
+        add_content_ref(template.parquet_hash)
+        if i % 10 == 0 and not ExternalUsers.query.filter_by(email=f"member{i % 200}@union.com").first():
+            db.session.add(ExternalUsers(first_name="Member", last_name=str(i), email=f"member{i % 200}@union.com", union=f"Union {i % 20}"))
+    db.session.commit()
+    return template.id
+
+def hit_route(client, url, repeat):
+    for _ in range(repeat):
+        response = client.get(url)
+        response.get_data()
+        assert response.status_code == 200, (url, response.status_code)
+
+def routes(portal, uri, sizes, repeat):
+    results = []
+    for size in sizes:
+        with portal.app.app_context():
+            file_id = fill_cleaned(portal, size)
+        cases = [
+            ('inthome', '/internal/files'),
+            ('api_files', '/api/files?limit=50'),
+            ('admin', '/admin'),
+            ('preview', f'/preview/{file_id}'),
+            ('download', f'/download/{file_id}'),
+        ]
+        for name, url in cases:
+            case = run_isolated(uri, {'kind': 'route', 'url': url, 'repeat': repeat})
+            seconds, peak, growth = case['seconds'], case['peak_rss'], case['peak_rss'] - case['start_rss']
+            results.append({'route': name, 'files': size, 'requests': repeat, 'seconds': round(seconds, 4),
+                            'requests_per_second': round(repeat / seconds, 1), 'peak_rss_mb': round(peak / 2**20, 1), 'rss_growth_mb': round(growth / 2**20, 1)})
+            print(f"{name:>12} {size:>7} files {repeat / seconds:>10.1f} req/s {peak / 2**20:>8.1f} MB (+{growth / 2**20:.1f})")
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+# Ratio of throughput against an earlier report, > 1 means faster now
+def compare(report, baseline):
+    def keyed(rows, fields):
+        return {tuple(r[f] for f in fields): r for r in rows}
+    print(f"\nvs {baseline.get('commit')}:")
+    old = keyed(baseline.get('ingest', []), ('path', 'format', 'rows'))
+    for key, row in keyed(report['ingest'], ('path', 'format', 'rows')).items():
+        if key in old:
+            print(f"{' '.join(map(str, key)):>30} {row['rows_per_second'] / old[key]['rows_per_second']:>6.2f}x  rss {row['peak_rss_mb'] - old[key]['peak_rss_mb']:+.1f} MB")
+    old = keyed(baseline.get('routes', []), ('route', 'files'))
+    for key, row in keyed(report['routes'], ('route', 'files')).items():
+        if key in old:
+            print(f"{' '.join(map(str, key)):>30} {row['requests_per_second'] / old[key]['requests_per_second']:>6.2f}x  rss {row['peak_rss_mb'] - old[key]['peak_rss_mb']:+.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--formats", nargs="+", default=['csv', 'xlsx', 'txt'])
+    parser.add_argument("--files", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--db", default=os.getenv("BENCH_DATABASE_URI"))
+    parser.add_argument("--out", default="bench_report.json")
+    parser.add_argument("--compare")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(args.db, json.loads(args.case))))
+        sys.exit(0)
+
+    workdir = tempfile.mkdtemp(prefix="census-bench-")
+    uri = args.db or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    try:
+        portal = load_portal(uri)
+        report = {
+            'commit': git_commit(),
+            'run_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'machine': {'cpus': os.cpu_count(), 'memory_mb': round(psutil.virtual_memory().total / 2**20)},
+            'database': uri.split('://')[0],
+            'ingest': ingest(uri, workdir, args.rows, args.formats),
+            'routes': routes(portal, uri, args.files, args.repeat),
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written: {args.out}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
@@ -0,0 +1,51 @@
+'''
+Cost of the data quality checks (quality_report) next to the rest of the cleaning pipeline. Runs the
+checks on a synthetic census with some broken emails, zips, phones and dobs, and compares them to
+clean_census() and the parquet serialise step on the same frame. Target is under 10% of the total.
+
+Usage: python benchmarks/bench_quality.py --rows 100000 1000000
+'''
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from synthetic import census_frame, messy_census_frame
+from dataops.quality import quality_report
+from dataops.pipeline import clean_census
+from dataops.blob import to_parquet_bytes
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+# Breaks about 2% of the values in each checked column
+def with_errors(df, seed=0):
+    rng = np.random.default_rng(seed)
+    df = df.copy()
+    for column, bad in (('email', 'not-an-email'), ('zip_code', '9X1'), ('phone', '555-12'), ('dob', '2999-01-01')):
+        df.loc[rng.random(len(df)) < 0.02, column] = bad
+    return df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[100000, 1000000])
+    args = parser.parse_args()
+
+    print(f"{'rows':>9} {'clean s':>9} {'parquet s':>10} {'checks s':>9} {'overhead':>9} {'invalid':>9}")
+    for rows in args.rows:
+        # The synthetic frame is built outside the timing, only the clean itself counts toward the baseline
+        messy = messy_census_frame(rows)
+        _, clean_seconds = timed(lambda: clean_census(messy))
+        df = with_errors(census_frame(rows, dupe_rate=0.05))
+        _, parquet_seconds = timed(lambda: to_parquet_bytes(df))
+        report, check_seconds = timed(lambda: quality_report(df))
+        overhead = check_seconds / (clean_seconds + parquet_seconds + check_seconds)
+        print(f"{rows:>9} {clean_seconds:>9.2f} {parquet_seconds:>10.2f} {check_seconds:>9.2f} {overhead:>8.1%} {report['invalid_rows']:>9}")
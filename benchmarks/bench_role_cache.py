@@ -0,0 +1,72 @@
+'''
+Benchmark for role resolution on authenticated requests. Compares the old path (load_user and
+User.get_role each querying both whitelist tables, then a route-level whitelist query) with the
+cached resolve_role() used now. Reports simulated requests per second for the auth step alone.
+
+Usage: python benchmarks/bench_role_cache.py --users 2000 --requests 20000
+'''
+
+import os
+import sys
+import time
+import random
+import argparse
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from dbmanager import db
+from dataops.models import InternalUsers, ExternalUsers
+from dataops.whitelist import resolve_role, invalidate_role
+
+
+def make_app(uri):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    db.init_app(app)
+    return app
+
+def fill(users):
+    for i in range(users):
+        if i % 10 == 0:
+            db.session.add(InternalUsers(first_name="Admin", last_name=str(i), email=f"admin{i}@unionone.com", uploaded_at=datetime.now()))
+        else:
+            db.session.add(ExternalUsers(first_name="Member", last_name=str(i), email=f"member{i}@union.com", union=f"Union {i % 20}", uploaded_at=datetime.now()))
+    db.session.commit()
+    return [f"admin{i}@unionone.com" if i % 10 == 0 else f"member{i}@union.com" for i in range(users)]
+
+# What every request cost before the cache: load_user, User.get_role, then the route check
+def uncached_auth(email):
+    InternalUsers.query.filter_by(email=email).first() or ExternalUsers.query.filter_by(email=email).first()
+    if InternalUsers.query.filter_by(email=email).first():
+        role = 'internal'
+    else:
+        role = ExternalUsers.query.filter_by(email=email).first().union
+    if role != 'internal':
+        ExternalUsers.query.filter_by(email=email).first()
+    return role
+
+def run(fn, emails, requests):
+    start = time.perf_counter()
+    for _ in range(requests):
+        fn(random.choice(emails))
+    return requests / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--db", default=os.getenv("BENCH_DATABASE_URI", "sqlite://"))
+    args = parser.parse_args()
+
+    app = make_app(args.db)
+    with app.app_context():
+        db.create_all()
+        emails = fill(args.users)
+        random.seed(0)
+        invalidate_role()
+        print(f"uncached auth: {run(uncached_auth, emails, args.requests):>10.0f} req/s")
+        invalidate_role()
+        print(f"cached auth:   {run(resolve_role, emails, args.requests):>10.0f} req/s")
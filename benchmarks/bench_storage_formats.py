@@ -0,0 +1,50 @@
+'''
+Compares the storage formats for cleaned censuses: write time, size and read time of the excel copy
+(xlsxwriter / openpyxl, the old XLSX-only path) against the parquet copy now stored by clean_blob().
+
+Usage: python benchmarks/bench_storage_formats.py --rows 1000 10000 100000
+'''
+
+import os
+import sys
+import time
+import argparse
+import io
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+from synthetic import census_frame
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+def excel_write(df):
+    output = io.BytesIO()
+    df.to_excel(output, index=False, engine='xlsxwriter')
+    return output.getvalue()
+
+def parquet_write(df, compression):
+    output = io.BytesIO()
+    df.to_parquet(output, index=False, compression=compression)
+    return output.getvalue()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--compression", default="zstd")
+    args = parser.parse_args()
+
+    print(f"{'rows':>8} {'format':>8} {'write s':>9} {'size MB':>9} {'read s':>9}")
+    for rows in args.rows:
+        df = census_frame(rows)
+        xlsx, xlsx_write = timed(lambda: excel_write(df))
+        _, xlsx_read = timed(lambda: pd.read_excel(io.BytesIO(xlsx)))
+        parquet, parquet_write_time = timed(lambda: parquet_write(df, args.compression))
+        _, parquet_read = timed(lambda: pd.read_parquet(io.BytesIO(parquet)))
+        print(f"{rows:>8} {'xlsx':>8} {xlsx_write:>9.3f} {len(xlsx) / 2**20:>9.2f} {xlsx_read:>9.3f}")
+        print(f"{rows:>8} {'parquet':>8} {parquet_write_time:>9.3f} {len(parquet) / 2**20:>9.2f} {parquet_read:>9.3f}")
@@ -0,0 +1,47 @@
+'''
+Synthetic census generator shared by the benchmarks. Values are random but shaped like real member
+rosters (names, emails, addresses, phones, dobs) and can repeat rows to give the dedupe step work.
+'''
+
+import numpy as np
+import pandas as pd
+
+FIRST_NAMES = ["James", "Maria", "Robert", "Linda", "Michael", "Patricia", "David", "Jennifer", "Jose", "Susan"]
+LAST_NAMES = ["Smith", "Garcia", "Johnson", "Brown", "Lee", "Martinez", "Davis", "Lopez", "Wilson", "Nguyen"]
+CITIES = [("Sacramento", "CA"), ("Portland", "OR"), ("Seattle", "WA"), ("Reno", "NV"), ("Boise", "ID")]
+
+# Clean column names as they come out of the pipeline
+def census_frame(rows, dupe_rate=0.0, seed=0):
+    rng = np.random.default_rng(seed)
+    unique = max(1, int(rows * (1 - dupe_rate)))
+    first = rng.choice(FIRST_NAMES, unique)
+    last = rng.choice(LAST_NAMES, unique)
+    ids = np.arange(unique)
+    city = rng.integers(0, len(CITIES), unique)
+    df = pd.DataFrame({
+        'first_name': first,
+        'last_name': last,
+        'email': [f"{f.lower()}.{l.lower()}{i}@example.com" for f, l, i in zip(first, last, ids)],
+        'address_one': [f"{n} Main St" for n in rng.integers(1, 9999, unique)],
+        'address_two': np.where(rng.random(unique) < 0.2, "Apt 2", ""),
+        'zip_code': [f"{z:05d}" for z in rng.integers(90000, 99999, unique)],
+        'state': [CITIES[c][1] for c in city],
+        'city': [CITIES[c][0] for c in city],
+        'phone': [f"({a}) {b}-{c:04d}" for a, b, c in zip(rng.integers(200, 999, unique), rng.integers(200, 999, unique), rng.integers(0, 9999, unique))],
+        'organization': rng.choice(["IUEC", "IBEW", "UA", "SMART"], unique),
+        'local': [f"Local {n}" for n in rng.integers(1, 500, unique)],
+        'dob': pd.to_datetime(rng.integers(-2 * 10**9, 10**9, unique), unit='s').strftime('%Y-%m-%d'),
+    })
+    if unique < rows:
+        df = pd.concat([df, df.sample(rows - unique, replace=True, random_state=seed)], ignore_index=True)
+    return df
+
+# Same data with headers the way unions actually send them
+MESSY_HEADERS = {
+    'first_name': 'First Name ', 'last_name': 'LAST', 'email': 'E-mail Address', 'address_one': 'Street',
+    'address_two': 'Addr 2', 'zip_code': 'Zip', 'state': 'ST', 'city': 'City/Town', 'phone': 'Cell #',
+    'organization': 'Org', 'local': 'Local Union', 'dob': 'Birth Date'
+}
+
+def messy_census_frame(rows, dupe_rate=0.05, seed=0):
+    return census_frame(rows, dupe_rate, seed).rename(columns=MESSY_HEADERS)
@@ -1,3 +1,20 @@
 from .models import *
+from .metrics import *
+from .stats import *
+from .codec import *
+from .objectstore import *
+from .content import *
 from .blob import *
-from .loader import *
\ No newline at end of file
+from .loader import *
+from .audit import *
+from .members import *
+from .listing import *
+from .whitelist import *
+from .preview import *
+from .quality import *
+from .delta import *
+from .mapping import *
+from .pipeline import *
+from .jobs import *
+from .archive import *
+from .migrations import *
\ No newline at end of file
@@ -0,0 +1,84 @@
+from dbmanager import db
+from .models import BlobContent, BlobContentPart, BlobOriginal, BlobCleaned
+from .content import iter_stored
+from .objectstore import object_store, content_key
+from .blob import DOWNLOAD_CHUNK_BYTES
+from datetime import datetime, timedelta
+from sqlalchemy import func, exists, or_
+import threading
+import time
+import os
+
+# Stored bytes only used by censuses older than this move to the object store
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 365))
+# Comma separated cleaned statuses (battery stages) that are archived whatever their age, empty to only go by age
+ARCHIVE_STATUSES = [s.strip() for s in os.getenv("ARCHIVE_STATUSES", "").split(",") if s.strip()]
+ARCHIVE_BATCH_ROWS = int(os.getenv("ARCHIVE_BATCH_ROWS", 20))
+# Seconds between background archive runs in the watcher process, 0 turns it off
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", 0))
+
+# Content still in the table that no recent original and no recent, unfinished cleaned census points at
+def _cold_content(cutoff):
+    recent_original = exists().where(BlobOriginal.content_hash == BlobContent.hash, BlobOriginal.uploaded_at >= cutoff)
+    hot_cleaned = BlobCleaned.uploaded_at >= cutoff
+    if ARCHIVE_STATUSES:
+        hot_cleaned = hot_cleaned & BlobCleaned.status.notin_(ARCHIVE_STATUSES)
+    uses = or_(BlobCleaned.content_hash == BlobContent.hash, BlobCleaned.parquet_hash == BlobContent.hash, BlobCleaned.keys_hash == BlobContent.hash)
+    recent_cleaned = exists().where(uses, hot_cleaned)
+    return BlobContent.archive_key.is_(None) & ~recent_original & ~recent_cleaned
+
+# Copies one content row's stored bytes into the object store and leaves only the key in the row, None if the copy fell short
+def archive_content(content_hash):
+    stored_size = db.session.query(func.coalesce(BlobContent.stored_size, func.length(BlobContent.data))).filter(BlobContent.hash == content_hash).scalar() or 0
+    key = content_key(content_hash)
+    written = object_store.put(key, iter_stored(content_hash, 0, stored_size - 1, DOWNLOAD_CHUNK_BYTES), stored_size)
+    if written != stored_size:
+        print(f"Archive of {content_hash} wrote {written} of {stored_size} bytes, left in the database")
+        return None
+    BlobContent.query.filter(BlobContent.hash == content_hash, BlobContent.archive_key.is_(None)) \
+        .update({'data': b'', 'archive_key': key, 'archived_at': datetime.now(), 'part_size': None}, synchronize_session=False)
+    BlobContentPart.query.filter(BlobContentPart.hash == content_hash).delete(synchronize_session=False)
+    return written
+
+# Moves cold content to the object store in batches by hash, one short transaction per batch
+# Stops after `limit` rows when given. Reads of archived content go to the object store transparently
+def archive_blobs(batch_size=ARCHIVE_BATCH_ROWS, limit=None):
+    cutoff = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    report = {'rows': 0, 'bytes_moved': 0}
+    start = time.perf_counter()
+    last = ''
+    while limit is None or report['rows'] < limit:
+        size = batch_size if limit is None else min(batch_size, limit - report['rows'])
+        hashes = [h for (h,) in db.session.query(BlobContent.hash).filter(BlobContent.hash > last, _cold_content(cutoff)).order_by(BlobContent.hash).limit(size)]
+        if not hashes:
+            break
+        for content_hash in hashes:
+            moved = archive_content(content_hash)
+            if moved is not None:
+                report['rows'] += 1
+                report['bytes_moved'] += moved
+        db.session.commit()
+        last = hashes[-1]
+    report['seconds'] = round(time.perf_counter() - start, 2)
+    print(f"Archived {report['rows']} blobs, {report['bytes_moved']} bytes moved in {report['seconds']}s")
+    return report
+
+def _archive_loop(app, interval):
+    while True:
+        time.sleep(interval)
+        with app.app_context():
+            try:
+                archive_blobs()
+            except Exception as e:
+                print(f"Archive run failed: {e}")
+                db.session.rollback()
+
+# Runs archive_blobs() every `interval` seconds on a daemon thread
+def start_archiver(app, interval=None):
+    interval = ARCHIVE_INTERVAL if interval is None else interval
+    if not interval:
+        return None
+    thread = threading.Thread(target=_archive_loop, args=(app, interval), name="blob-archiver", daemon=True)
+    thread.start()
+    print(f"ARCHIVER: every {interval}s, after {ARCHIVE_AFTER_DAYS} days")
+    return thread
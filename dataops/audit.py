@@ -0,0 +1,108 @@
+from dbmanager import db
+from .models import UserLog
+from flask import current_app
+from sqlalchemy.exc import OperationalError
+from datetime import datetime
+import threading
+import atexit
+import os
+
+AUDIT_FLUSH_ROWS = int(os.getenv("AUDIT_FLUSH_ROWS", 200))
+AUDIT_FLUSH_SECONDS = float(os.getenv("AUDIT_FLUSH_SECONDS", 2))
+# Entries held while the database can't take them, newer entries are dropped (and counted) past this
+AUDIT_BUFFER_MAX = int(os.getenv("AUDIT_BUFFER_MAX", 10000))
+
+def _width(column):
+    return UserLog.__table__.c[column].type.length
+
+# Buffers UserLog rows and writes them in one multi-row insert from a background thread
+# Flushes when AUDIT_FLUSH_ROWS are waiting or every AUDIT_FLUSH_SECONDS, and once more at exit
+class AuditWriter:
+    def __init__(self):
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._app = None
+        self._thread = None
+        self._pid = None
+        self.dropped = 0
+
+    # Values are cut to their column widths, so a long filename can't fail the insert
+    def log(self, user, file, action):
+        row = {'user': str(user or '')[:_width('user')], 'file': str(file or '')[:_width('file')],
+               'action': str(action or '')[:_width('action')], 'timestamp': datetime.now()}
+        with self._lock:
+            if len(self._buffer) >= AUDIT_BUFFER_MAX:
+                self._drop(1)
+                return
+            self._buffer.append(row)
+            full = len(self._buffer) >= AUDIT_FLUSH_ROWS
+        self._ensure_started()
+        if full:
+            self._wake.set()
+
+    # Started lazily, so each gunicorn worker (forked after import) gets its own flush thread
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._app = current_app._get_current_object()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+            self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wake.wait(AUDIT_FLUSH_SECONDS)
+            self._wake.clear()
+            self.flush()
+
+    # Caller holds self._lock
+    def _drop(self, count):
+        if self.dropped == 0 or (self.dropped + count) // 1000 > self.dropped // 1000:
+            print(f"Audit buffer full ({AUDIT_BUFFER_MAX}), {self.dropped + count} entries dropped so far")
+        self.dropped += count
+
+    # Puts rows back at the front of the buffer, as many as fit under AUDIT_BUFFER_MAX
+    def _requeue(self, rows):
+        with self._lock:
+            keep = max(AUDIT_BUFFER_MAX - len(self._buffer), 0)
+            if len(rows) > keep:
+                self._drop(len(rows) - keep)
+            self._buffer[:0] = rows[:keep]
+
+    # Writes everything buffered so far in one insert. When that fails the rows are tried one at a time:
+    # a row the database rejects is dropped with a log line, and when the database can't be reached the rest are kept
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                rows, self._buffer = self._buffer, []
+            if not rows or self._app is None:
+                return
+            with self._app.app_context():
+                try:
+                    with db.engine.begin() as conn:
+                        conn.execute(UserLog.__table__.insert(), rows)
+                    return
+                except Exception as e:
+                    print(f"Audit log flush of {len(rows)} entries failed, retrying one by one: {e}")
+                for i, row in enumerate(rows):
+                    try:
+                        with db.engine.begin() as conn:
+                            conn.execute(UserLog.__table__.insert(), [row])
+                    except OperationalError as e:
+                        print(f"Audit log flush failed, keeping {len(rows) - i} entries: {e}")
+                        self._requeue(rows[i:])
+                        return
+                    except Exception as e:
+                        print(f"Audit log entry dropped {row}: {e}")
+
+audit_log = AuditWriter()
+
+# For inserting user l0gs, queued and written in batches by audit_log
+def insert_log(user, file, action):
+    audit_log.log(user, file, action)
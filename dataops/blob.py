@@ -1,19 +1,79 @@
 from dbmanager import db
-from .models import BlobOriginal, BlobCleaned
+from .models import BlobOriginal, BlobCleaned, BlobContent
+from .stats import record_upload
+from .content import put_content, put_content_file, add_content_ref, drop_content_ref, read_content, iter_column, iter_content
+from .metrics import stage_seconds
+from contextlib import contextmanager
 from datetime import datetime
+from sqlalchemy import func
+import pandas as pd
+import pyarrow.parquet as pq
+import threading
+import time
+import io
+import os
 
-# Encapsulates logic for inserting uncleaned blob
-def unclean_blob(filename, union, email, blob_data, file_type):
+DOWNLOAD_CHUNK_BYTES = int(os.getenv("DOWNLOAD_CHUNK_BYTES", 4 * 1024 * 1024))
+PARQUET_COMPRESSION = os.getenv("PARQUET_COMPRESSION", "zstd")
+
+# Keeps two first downloads of the same file from both building the excel copy, {file id: (lock, waiting threads)}
+# Downloads of other files don't wait on it
+_excel_locks = {}
+_excel_locks_guard = threading.Lock()
+
+@contextmanager
+def _excel_lock(file_id):
+    with _excel_locks_guard:
+        lock, users = _excel_locks.get(file_id, (None, 0))
+        lock = lock or threading.Lock()
+        _excel_locks[file_id] = (lock, users + 1)
+    try:
+        with lock:
+            yield
+    finally:
+        with _excel_locks_guard:
+            lock, users = _excel_locks[file_id]
+            if users == 1:
+                del _excel_locks[file_id]
+            else:
+                _excel_locks[file_id] = (lock, users - 1)
+
+# Converts cleaned census to excel bytes for BLOB storage
+def to_excel_bytes(df):
+    output = io.BytesIO()
+    df.to_excel(output, index=False, engine='xlsxwriter')
+    return output.getvalue()
+
+# Converts cleaned census to compressed parquet bytes, the internal storage format
+def to_parquet_bytes(df):
+    output = io.BytesIO()
+    df.to_parquet(output, index=False, compression=PARQUET_COMPRESSION)
+    return output.getvalue()
+
+# Encapsulates logic for inserting uncleaned blob, the bytes go to blob_content and are stored once per hash
+# blob_data is bytes, or a seekable file which is stored in parts without reading it whole
+def unclean_blob(filename, union, email, blob_data, file_type, content_hash=None):
+    if isinstance(blob_data, (bytes, bytearray)):
+        content_hash = put_content(blob_data, content_hash)
+    else:
+        content_hash = put_content_file(blob_data, content_hash)
     file = BlobOriginal(
         filename=filename,
         union=union,
         email=email,
-        file_blob=blob_data,
         file_type=file_type,
-        uploaded_at=datetime.now()
+        uploaded_at=datetime.now(),
+        content_hash=content_hash
     )
     db.session.add(file)
     db.session.commit()
+    return file
+
+# Bytes of a stored original, inline for older rows and from blob_content otherwise
+def original_bytes(original):
+    if original.file_blob is not None:
+        return original.file_blob
+    return read_content(original.content_hash)
 
 # Encapsulates logic for inserting cleaned blob
 def clean_blob_excel(filename, union, email, excel_blob: bytes, rowcount):
@@ -22,11 +82,138 @@ def clean_blob_excel(filename, union, email, excel_blob: bytes, rowcount):
         filename=cleaned_filename,
         union=union,
         email=email,
-        file_blob=excel_blob,
         file_type="xlsx",
         uploaded_at=datetime.now(),
         rowcount=rowcount,
+        status="0",
+        file_size=len(excel_blob),
+        content_hash=put_content(excel_blob)
+    )
+    db.session.add(upload)
+    record_upload(email, union, upload.uploaded_at, rowcount)
+    db.session.commit()
+    return upload
+
+# Encapsulates logic for inserting a cleaned census, stored as parquet with the excel copy built on first download
+def clean_blob(filename, union, email, df, rowcount, source_hash=None):
+    return clean_blob_parquet(filename, union, email, to_parquet_bytes(df), rowcount, source_hash)
+
+# Same as clean_blob for a census that was already written out as parquet, as bytes or a seekable file
+def clean_blob_parquet(filename, union, email, parquet_blob, rowcount, source_hash=None):
+    cleaned_filename = filename.rsplit('.', 1)[0] + ".xlsx"
+    upload = BlobCleaned(
+        filename=cleaned_filename,
+        union=union,
+        email=email,
+        parquet_hash=put_content(parquet_blob) if isinstance(parquet_blob, (bytes, bytearray)) else put_content_file(parquet_blob),
+        source_hash=source_hash,
+        file_type="xlsx",
+        uploaded_at=datetime.now(),
+        rowcount=rowcount,
+        status="0",
+        loaded=False
+    )
+    # Counted in the upload stats by load_structured() once it is loaded, a failed load never counts
+    db.session.add(upload)
+    db.session.commit()
+    return upload
+
+# New cleaned row for a re-upload of identical content, sharing the earlier row's stored files
+def copy_cleaned(previous, filename, union, email):
+    upload = BlobCleaned(
+        filename=filename.rsplit('.', 1)[0] + ".xlsx",
+        union=union,
+        email=email,
+        parquet_hash=previous.parquet_hash,
+        content_hash=previous.content_hash,
+        file_size=previous.file_size,
+        source_hash=previous.source_hash,
+        reused=True,
+        file_type="xlsx",
+        uploaded_at=datetime.now(),
+        rowcount=previous.rowcount,
+        invalid_rows=previous.invalid_rows,
+        keys_hash=previous.keys_hash,
         status="0"
     )
+    add_content_ref(previous.parquet_hash)
+    add_content_ref(previous.content_hash)
+    add_content_ref(previous.keys_hash)
     db.session.add(upload)
-    db.session.commit()
\ No newline at end of file
+    record_upload(email, union, upload.uploaded_at, upload.rowcount)
+    db.session.commit()
+    return upload
+
+# Latest cleaned result for an original with this content hash, if one can be shared
+def find_cleaned_by_source(source_hash):
+    return BlobCleaned.query.filter(BlobCleaned.source_hash == source_hash, BlobCleaned.parquet_hash.isnot(None), BlobCleaned.loaded.is_(True)) \
+        .order_by(BlobCleaned.id.desc()).first()
+
+# Builds and stores the excel copy of a cleaned census if it doesn't exist yet
+# Another process may store its copy first, then the conditional update changes nothing and the extra reference is dropped
+def ensure_cleaned_excel(file_id):
+    missing = BlobCleaned.query.with_entities(BlobCleaned.id).filter(BlobCleaned.id == file_id, BlobCleaned.file_blob.is_(None), BlobCleaned.content_hash.is_(None)).first()
+    if not missing:
+        return
+    with _excel_lock(file_id):
+        upload = BlobCleaned.query.with_entities(BlobCleaned.union, BlobCleaned.content_hash).filter(BlobCleaned.id == file_id).first()
+        if upload.content_hash is not None:
+            return
+        start = time.perf_counter()
+        excel_blob = to_excel_bytes(load_cleaned_frame(file_id))
+        stage_seconds.observe(('xlsx_serialise', 'download', upload.union), time.perf_counter() - start)
+        content_hash = put_content(excel_blob)
+        updated = BlobCleaned.query.filter(BlobCleaned.id == file_id, BlobCleaned.content_hash.is_(None)) \
+            .update({'content_hash': content_hash, 'file_size': len(excel_blob)}, synchronize_session=False)
+        if not updated:
+            drop_content_ref(content_hash)
+        db.session.commit()
+
+# Cleaned census as a DataFrame, from parquet when stored that way and from the excel copy otherwise
+def load_cleaned_frame(file_id, nrows=None):
+    parquet_blob, parquet_hash = db.session.query(BlobCleaned.parquet_blob, BlobCleaned.parquet_hash).filter(BlobCleaned.id == file_id).one()
+    if parquet_blob is None and parquet_hash is not None:
+        parquet_blob = read_content(parquet_hash)
+    if parquet_blob is not None:
+        parquet = pq.ParquetFile(io.BytesIO(parquet_blob))
+        if nrows is None:
+            return parquet.read().to_pandas()
+        batch = next(parquet.iter_batches(batch_size=nrows), None)
+        return batch.to_pandas() if batch is not None else parquet.schema_arrow.empty_table().to_pandas()
+    meta = cleaned_blob_meta(file_id)
+    excel_data = io.BytesIO(b"".join(iter_cleaned_blob(file_id, 0, (meta.size or 0) - 1, meta=meta)))
+    return pd.read_excel(excel_data, nrows=nrows)
+
+# Filename, size and hash of a cleaned BLOB without pulling the bytes, inline is set for older rows holding their own bytes
+def cleaned_blob_meta(file_id):
+    return db.session.query(
+        BlobCleaned.filename,
+        BlobCleaned.content_hash,
+        func.coalesce(BlobCleaned.file_size, func.length(BlobCleaned.file_blob)).label("size"),
+        BlobCleaned.file_blob.isnot(None).label("inline")
+    ).filter(BlobCleaned.id == file_id).first()
+
+# Reads bytes start..end (inclusive) of a cleaned BLOB from the database one chunk at a time
+def iter_cleaned_blob(file_id, start, end, chunk_size=DOWNLOAD_CHUNK_BYTES, meta=None):
+    meta = meta or cleaned_blob_meta(file_id)
+    if meta.inline:
+        return iter_column(BlobCleaned.file_blob, BlobCleaned.id == file_id, start, end, chunk_size)
+    return iter_content(meta.content_hash, start, end, chunk_size)
+
+# Size of a stored original without pulling its bytes
+def original_size(original):
+    size = db.session.query(BlobContent.size).filter(BlobContent.hash == original.content_hash).scalar()
+    if size is None:
+        size = db.session.query(func.length(BlobOriginal.file_blob)).filter(BlobOriginal.id == original.id).scalar()
+    return size or 0
+
+# Copies a stored original into a file chunk by chunk, so large censuses never sit in memory whole
+def copy_original_to(original, fileobj, chunk_size=DOWNLOAD_CHUNK_BYTES):
+    size = original_size(original)
+    if db.session.query(BlobContent.hash).filter(BlobContent.hash == original.content_hash).first():
+        chunks = iter_content(original.content_hash, 0, size - 1, chunk_size)
+    else:
+        chunks = iter_column(BlobOriginal.file_blob, BlobOriginal.id == original.id, 0, size - 1, chunk_size)
+    for chunk in chunks:
+        fileobj.write(chunk)
+    fileobj.flush()
@@ -0,0 +1,57 @@
+import zlib
+import gzip
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Codec for new stored bytes: zstd, gzip or none. zstd falls back to gzip when zstandard isn't installed
+STORAGE_CODEC = os.getenv("STORAGE_CODEC", "zstd")
+STORAGE_LEVEL = int(os.getenv("STORAGE_LEVEL", 0))
+# Bytes that shrink by less than this (xlsx and parquet are compressed already) are kept as they are
+STORAGE_MIN_SAVING = float(os.getenv("STORAGE_MIN_SAVING", 0.05))
+
+CODECS = ('none', 'gzip', 'zstd')
+
+def storage_codec():
+    if STORAGE_CODEC == 'zstd' and zstandard is None:
+        return 'gzip'
+    return STORAGE_CODEC if STORAGE_CODEC in CODECS else 'none'
+
+# Compressed bytes with the codec used, 'none' when compressing didn't pay off
+def encode(data, codec=None):
+    codec = codec or storage_codec()
+    if codec == 'zstd':
+        packed = zstandard.ZstdCompressor(level=STORAGE_LEVEL or 3).compress(data)
+    elif codec == 'gzip':
+        packed = gzip.compress(data, compresslevel=STORAGE_LEVEL or 6)
+    else:
+        return 'none', data
+    if len(packed) > len(data) * (1 - STORAGE_MIN_SAVING):
+        return 'none', data
+    return codec, packed
+
+def decode(codec, data):
+    if data is None or codec in (None, 'none'):
+        return data
+    return decompressor(codec).decompress(bytes(data))
+
+# Incremental compressor with compress()/flush(), for content written from a file chunk by chunk
+def compressor(codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=STORAGE_LEVEL or 3).compressobj()
+    if codec == 'gzip':
+        return zlib.compressobj(STORAGE_LEVEL or 6, zlib.DEFLATED, 31)
+    raise ValueError(f"Unknown storage codec: {codec}")
+
+# Incremental decompressor, fed the stored bytes chunk by chunk for streamed reads
+def decompressor(codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstandard is needed to read zstd compressed blobs")
+        return zstandard.ZstdDecompressor().decompressobj()
+    if codec == 'gzip':
+        return zlib.decompressobj(wbits=31)
+    raise ValueError(f"Unknown storage codec: {codec}")
@@ -0,0 +1,231 @@
+from dbmanager import db
+from .models import BlobContent, BlobContentPart, BlobCleaned, BlobOriginal
+from .codec import encode, decode, compressor, decompressor, storage_codec, STORAGE_MIN_SAVING
+from .objectstore import object_store
+from sqlalchemy import func
+from sqlalchemy.dialects import mysql, sqlite
+import tempfile
+import hashlib
+import time
+import os
+
+# Content bigger than this is written from a file in parts of this size, so it is never held in memory whole
+CONTENT_PART_BYTES = int(os.getenv("CONTENT_PART_BYTES", 8 * 1024 * 1024))
+
+# Stores bytes once under their sha256 (of the uncompressed bytes), another reference only bumps ref_count
+# New bytes are compressed with STORAGE_CODEC, size is always the uncompressed length. Runs in the caller's transaction
+def put_content(data, content_hash=None):
+    content_hash = content_hash or hashlib.sha256(data).hexdigest()
+    table = BlobContent.__table__
+    if db.session.query(BlobContent.hash).filter(BlobContent.hash == content_hash).first():
+        db.session.execute(table.update().where(table.c.hash == content_hash).values(ref_count=table.c.ref_count + 1))
+        return content_hash
+    codec, stored = encode(data)
+    _insert_content({'hash': content_hash, 'data': stored, 'size': len(data), 'stored_size': len(stored), 'codec': codec, 'tried_codec': storage_codec(), 'ref_count': 1})
+    return content_hash
+
+# Another process may have stored the same bytes since the check, the upsert turns that into a reference
+def _insert_content(values):
+    table = BlobContent.__table__
+    if db.engine.dialect.name == 'sqlite':
+        stmt = sqlite.insert(table).values(**values).on_conflict_do_update(index_elements=['hash'], set_={'ref_count': table.c.ref_count + 1})
+    else:
+        stmt = mysql.insert(table).values(**values).on_duplicate_key_update(ref_count=table.c.ref_count + 1)
+    db.session.execute(stmt)
+
+def _file_chunks(fileobj, chunk_size):
+    fileobj.seek(0)
+    while chunk := fileobj.read(chunk_size):
+        yield chunk
+
+# put_content for bytes in a seekable file, read CONTENT_PART_BYTES at a time for the hash, compression and insert
+# Anything bigger than one part is compressed into a temporary file and inserted as parts, so memory stays at about one part
+def put_content_file(fileobj, content_hash=None):
+    if content_hash is None:
+        digest = hashlib.sha256()
+        for chunk in _file_chunks(fileobj, CONTENT_PART_BYTES):
+            digest.update(chunk)
+        content_hash = digest.hexdigest()
+    if db.session.query(BlobContent.hash).filter(BlobContent.hash == content_hash).first():
+        add_content_ref(content_hash)
+        return content_hash
+    size = fileobj.seek(0, os.SEEK_END)
+    if size <= CONTENT_PART_BYTES:
+        fileobj.seek(0)
+        return put_content(fileobj.read(), content_hash)
+
+    codec = tried_codec = storage_codec()
+    with tempfile.TemporaryFile() as packed:
+        if codec != 'none':
+            pack = compressor(codec)
+            for chunk in _file_chunks(fileobj, CONTENT_PART_BYTES):
+                packed.write(pack.compress(chunk))
+            packed.write(pack.flush())
+        if codec == 'none' or packed.tell() > size * (1 - STORAGE_MIN_SAVING):
+            codec, stored = 'none', fileobj
+        else:
+            stored = packed
+        stored_size = stored.seek(0, os.SEEK_END)
+        table = BlobContentPart.__table__
+        for part, chunk in enumerate(_file_chunks(stored, CONTENT_PART_BYTES)):
+            # Same bytes written by another process at the same time produce the same parts
+            if db.engine.dialect.name == 'sqlite':
+                stmt = sqlite.insert(table).values(hash=content_hash, part=part, data=chunk).on_conflict_do_nothing(index_elements=['hash', 'part'])
+            else:
+                stmt = mysql.insert(table).values(hash=content_hash, part=part, data=chunk).prefix_with('IGNORE')
+            db.session.execute(stmt)
+    _insert_content({'hash': content_hash, 'data': b'', 'size': size, 'stored_size': stored_size, 'codec': codec, 'tried_codec': tried_codec, 'ref_count': 1, 'part_size': CONTENT_PART_BYTES})
+    return content_hash
+
+# Adds a reference to bytes that are already stored
+def add_content_ref(content_hash):
+    if content_hash:
+        db.session.execute(BlobContent.__table__.update().where(BlobContent.hash == content_hash).values(ref_count=BlobContent.ref_count + 1))
+
+# Takes back a reference that turned out not to be needed, the bytes stay stored
+def drop_content_ref(content_hash):
+    if content_hash:
+        db.session.execute(BlobContent.__table__.update().where(BlobContent.hash == content_hash, BlobContent.ref_count > 0).values(ref_count=BlobContent.ref_count - 1))
+
+# Bytes as they were stored, from the table (row or parts) or from the archive when the row only holds a pointer
+def read_content(content_hash):
+    row = db.session.query(BlobContent.codec, BlobContent.archive_key, BlobContent.part_size).filter(BlobContent.hash == content_hash).first()
+    if row is None:
+        return None
+    if row.archive_key:
+        return decode(row.codec, object_store.get(row.archive_key))
+    if row.part_size:
+        return decode(row.codec, b"".join(bytes(d) for (d,) in db.session.query(BlobContentPart.data).filter(BlobContentPart.hash == content_hash).order_by(BlobContentPart.part)))
+    return decode(row.codec, db.session.query(BlobContent.data).filter(BlobContent.hash == content_hash).scalar())
+
+# Reads bytes start..end (inclusive) of a BLOB column one chunk at a time
+def iter_column(column, match, start, end, chunk_size):
+    pos = start
+    while pos <= end:
+        length = min(chunk_size, end - pos + 1)
+        chunk = db.session.query(func.substr(column, pos + 1, length)).filter(match).scalar()
+        if not chunk:
+            break
+        yield bytes(chunk)
+        pos += len(chunk)
+
+# Stored bytes start..end (inclusive) of content kept in parts, one part row at a time
+def _iter_parts(content_hash, part_size, start, end):
+    part = start // part_size
+    pos = part * part_size
+    while pos <= end:
+        data = db.session.query(BlobContentPart.data).filter(BlobContentPart.hash == content_hash, BlobContentPart.part == part).scalar()
+        if not data:
+            break
+        data = bytes(data)
+        yield data[max(start - pos, 0):end - pos + 1]
+        pos += len(data)
+        part += 1
+
+def _stored_chunks(content_hash, archive_key, part_size, start, end, chunk_size):
+    if archive_key:
+        return object_store.iter_range(archive_key, start, end, chunk_size)
+    if part_size:
+        return _iter_parts(content_hash, part_size, start, end)
+    return iter_column(BlobContent.data, BlobContent.hash == content_hash, start, end, chunk_size)
+
+# Stored (still compressed) bytes start..end (inclusive) of content, wherever they are kept
+def iter_stored(content_hash, start, end, chunk_size):
+    archive_key, part_size = db.session.query(BlobContent.archive_key, BlobContent.part_size).filter(BlobContent.hash == content_hash).one()
+    return _stored_chunks(content_hash, archive_key, part_size, start, end, chunk_size)
+
+# Uncompressed bytes start..end (inclusive) of stored content, decompressed as the chunks come in
+# Compressed content has to be read from the beginning, output before start is dropped
+def iter_content(content_hash, start, end, chunk_size):
+    codec, stored_size, archive_key, part_size = db.session.query(BlobContent.codec, func.coalesce(BlobContent.stored_size, BlobContent.size), BlobContent.archive_key, BlobContent.part_size) \
+        .filter(BlobContent.hash == content_hash).one()
+    if codec == 'none':
+        yield from _stored_chunks(content_hash, archive_key, part_size, start, end, chunk_size)
+        return
+    unpack = decompressor(codec)
+    pos = 0
+    for chunk in _stored_chunks(content_hash, archive_key, part_size, 0, stored_size - 1, chunk_size):
+        out = unpack.decompress(chunk)
+        lo, hi = max(start - pos, 0), min(end - pos + 1, len(out))
+        pos += len(out)
+        for offset in range(lo, hi, chunk_size):
+            yield out[offset:min(offset + chunk_size, hi)]
+        if pos > end:
+            return
+
+# Unique bytes stored vs bytes referenced (the difference is what dedupe saved), and unique bytes after compression
+def content_totals():
+    stored, referenced, compressed = db.session.query(
+        func.coalesce(func.sum(BlobContent.size), 0),
+        func.coalesce(func.sum(BlobContent.size * BlobContent.ref_count), 0),
+        func.coalesce(func.sum(func.coalesce(BlobContent.stored_size, BlobContent.size)), 0)
+    ).one()
+    return int(stored), int(referenced), int(compressed)
+
+# Storage and cleaning work saved by dedupe and compression, for the report endpoint
+def dedupe_report():
+    stored, referenced, compressed = content_totals()
+    reused = BlobCleaned.query.filter(BlobCleaned.reused.is_(True)).count()
+    archived_rows, archived_bytes = db.session.query(func.count(BlobContent.hash), func.coalesce(func.sum(func.coalesce(BlobContent.stored_size, BlobContent.size)), 0)) \
+        .filter(BlobContent.archive_key.isnot(None)).one()
+    return {'stored_bytes': stored, 'referenced_bytes': referenced, 'bytes_saved': referenced - stored, 'reused_cleanings': reused,
+            'compressed_bytes': compressed, 'compression_saved': stored - compressed, 'archived_rows': archived_rows, 'archived_bytes': int(archived_bytes)}
+
+def _next_ids(column, after, condition, batch_size):
+    return [i for (i,) in db.session.query(column).filter(column > after, condition).order_by(column).limit(batch_size)]
+
+# Moves inline file_blob/parquet_blob bytes into the content store and recompresses stored content with STORAGE_CODEC
+# Works through each table by primary key in small batches, one short transaction per batch, so no table is held locked
+def recompress_blobs(batch_size=20, pause=0.0):
+    codec = storage_codec()
+    report = {'content_rows': 0, 'original_rows': 0, 'cleaned_rows': 0, 'bytes_before': 0, 'bytes_after': 0, 'inline_bytes_moved': 0}
+
+    last = ''
+    # Archived rows keep their codec, their bytes are no longer in the table. Content in parts was compressed as it was written
+    # Rows already tried with the codec, where it didn't save enough, are not read again
+    todo = (BlobContent.codec != codec) & ((BlobContent.tried_codec != codec) | BlobContent.tried_codec.is_(None)) \
+        & BlobContent.archive_key.is_(None) & BlobContent.part_size.is_(None)
+    while hashes := _next_ids(BlobContent.hash, last, todo, batch_size):
+        for content_hash in hashes:
+            row = db.session.query(BlobContent.data, BlobContent.codec, BlobContent.size).filter(BlobContent.hash == content_hash).one()
+            new_codec, stored = encode(decode(row.codec, row.data), codec)
+            update = BlobContent.__table__.update().where(BlobContent.hash == content_hash)
+            if new_codec != row.codec:
+                db.session.execute(update.values(data=stored, codec=new_codec, stored_size=len(stored), tried_codec=codec))
+                report['content_rows'] += 1
+                report['bytes_before'] += len(row.data)
+                report['bytes_after'] += len(stored)
+            else:
+                db.session.execute(update.values(tried_codec=codec))
+        db.session.commit()
+        last = hashes[-1]
+        time.sleep(pause)
+
+    last = 0
+    while ids := _next_ids(BlobOriginal.id, last, BlobOriginal.file_blob.isnot(None), batch_size):
+        for original_id in ids:
+            data = db.session.query(BlobOriginal.file_blob).filter(BlobOriginal.id == original_id).scalar()
+            content_hash = put_content(data)
+            BlobOriginal.query.filter(BlobOriginal.id == original_id).update({'content_hash': content_hash, 'file_blob': None}, synchronize_session=False)
+            report['original_rows'] += 1
+            report['inline_bytes_moved'] += len(data)
+        db.session.commit()
+        last = ids[-1]
+        time.sleep(pause)
+
+    last = 0
+    while ids := _next_ids(BlobCleaned.id, last, (BlobCleaned.file_blob.isnot(None)) | (BlobCleaned.parquet_blob.isnot(None)), batch_size):
+        for cleaned_id in ids:
+            excel, parquet = db.session.query(BlobCleaned.file_blob, BlobCleaned.parquet_blob).filter(BlobCleaned.id == cleaned_id).one()
+            values = {'file_blob': None, 'parquet_blob': None}
+            if excel is not None:
+                values.update(content_hash=put_content(excel), file_size=len(excel))
+            if parquet is not None:
+                values['parquet_hash'] = put_content(parquet)
+            BlobCleaned.query.filter(BlobCleaned.id == cleaned_id).update(values, synchronize_session=False)
+            report['cleaned_rows'] += 1
+            report['inline_bytes_moved'] += len(excel or b'') + len(parquet or b'')
+        db.session.commit()
+        last = ids[-1]
+        time.sleep(pause)
+    return report
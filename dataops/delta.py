@@ -0,0 +1,122 @@
+from dbmanager import db
+from .models import BlobCleaned, CensusDelta
+from .content import put_content, read_content
+from .blob import load_cleaned_frame, PARQUET_COMPRESSION
+from datetime import datetime
+import pyarrow.parquet as pq
+import pyarrow as pa
+import pandas as pd
+import numpy as np
+import json
+import io
+import os
+
+DELTA_SAMPLE_ROWS = int(os.getenv("DELTA_SAMPLE_ROWS", 20))
+# Only added and changed members go into cleaned_structured once a union has an earlier census
+DELTA_LOADS = os.getenv("DELTA_LOADS", "1") != "0"
+
+# Who a row is, shown in the change summary
+IDENTITY_COLUMNS = ['email', 'first_name', 'last_name']
+
+def _text(df, column):
+    if column not in df.columns:
+        return pd.Series("", index=df.index, dtype="string")
+    return df[column].astype("string").str.strip().fillna("")
+
+# Member key and row hash for every row of a cleaned census, plus the identity columns
+# Members are keyed by email, or by name and dob when there is no email
+def key_index(df):
+    email = _text(df, 'email').str.lower()
+    names = pd.DataFrame({c: _text(df, c).str.lower() for c in ('first_name', 'last_name', 'dob')})
+    by_email = pd.util.hash_pandas_object(email, index=False).to_numpy()
+    by_name = pd.util.hash_pandas_object(names, index=False).to_numpy()
+    index = pd.DataFrame({
+        'key': np.where(email.ne("").to_numpy(dtype=bool), by_email, by_name),
+        'row_hash': pd.util.hash_pandas_object(df.astype("string"), index=False).to_numpy(),
+    })
+    for column in IDENTITY_COLUMNS:
+        index[column] = _text(df, column).to_numpy()
+    return index
+
+def index_bytes(index):
+    output = io.BytesIO()
+    index.to_parquet(output, index=False, compression=PARQUET_COMPRESSION)
+    return output.getvalue()
+
+# Key index of an earlier cleaned census, built from its stored parquet the first time it's needed
+def _stored_index(cleaned):
+    if cleaned.keys_hash is None:
+        cleaned.keys_hash = put_content(index_bytes(key_index(load_cleaned_frame(cleaned.id))))
+        db.session.commit()
+    return pq.ParquetFile(io.BytesIO(read_content(cleaned.keys_hash)))
+
+def previous_version(cleaned):
+    return BlobCleaned.query.filter(BlobCleaned.union == cleaned.union, BlobCleaned.id < cleaned.id, BlobCleaned.parquet_hash.isnot(None), BlobCleaned.loaded.is_(True)) \
+        .order_by(BlobCleaned.id.desc()).first()
+
+# Identity columns of the rows at the given positions, read batch by batch
+def _pick_rows(parquet, positions):
+    positions = positions[:DELTA_SAMPLE_ROWS]
+    rows, offset = [], 0
+    for batch in parquet.iter_batches(columns=IDENTITY_COLUMNS):
+        wanted = positions[(positions >= offset) & (positions < offset + batch.num_rows)] - offset
+        if len(wanted):
+            rows.extend(batch.take(pa.array(wanted)).to_pylist())
+        offset += batch.num_rows
+        if len(rows) >= len(positions):
+            break
+    return rows
+
+# Added, changed and removed members between two key indexes, as positions in each
+def diff_versions(old_keys, old_hashes, new_keys, new_hashes):
+    if not len(old_keys):
+        return np.ones(len(new_keys), dtype=bool), np.zeros(len(new_keys), dtype=bool), np.empty(0, dtype=np.int64)
+    old_keys, first = np.unique(old_keys, return_index=True)
+    old_hashes = old_hashes[first]
+    found = pd.Index(old_keys).get_indexer(new_keys)
+    added = found == -1
+    changed = ~added & (old_hashes[found] != new_hashes)
+    removed = ~np.isin(old_keys, new_keys)
+    return added, changed, first[removed]
+
+# Stores the key index of a new cleaned census and records what changed since the union's last one
+# Returns a mask of the rows to load into cleaned_structured, None to load them all
+def record_delta(cleaned, index_blob):
+    cleaned.keys_hash = put_content(index_blob)
+    db.session.commit()
+    previous = previous_version(cleaned)
+    if previous is None:
+        return None
+
+    new_index = pq.ParquetFile(io.BytesIO(index_blob))
+    old_index = _stored_index(previous)
+    new = new_index.read(columns=['key', 'row_hash'])
+    old = old_index.read(columns=['key', 'row_hash'])
+    new_keys, new_hashes = new['key'].to_numpy(), new['row_hash'].to_numpy()
+    added, changed, removed = diff_versions(old['key'].to_numpy(), old['row_hash'].to_numpy(), new_keys, new_hashes)
+
+    summary = {
+        'cleaned_id': cleaned.id,
+        'previous_id': previous.id,
+        'previous_filename': previous.filename,
+        'added': int(np.count_nonzero(added)),
+        'changed': int(np.count_nonzero(changed)),
+        'removed': int(len(removed)),
+        'unchanged': int(len(new_keys) - np.count_nonzero(added) - np.count_nonzero(changed)),
+        'samples': {
+            'added': _pick_rows(new_index, np.flatnonzero(added)),
+            'changed': _pick_rows(new_index, np.flatnonzero(changed)),
+            'removed': _pick_rows(old_index, np.sort(removed)),
+        }
+    }
+    db.session.merge(CensusDelta(
+        cleaned_id=cleaned.id, previous_id=previous.id, added=summary['added'], changed=summary['changed'],
+        removed=summary['removed'], unchanged=summary['unchanged'], summary_json=json.dumps(summary), created_at=datetime.now()
+    ))
+    db.session.commit()
+    print(f"Delta {cleaned.union}: +{summary['added']} ~{summary['changed']} -{summary['removed']} against cleaned file {previous.id}")
+    return (added | changed) if DELTA_LOADS else None
+
+def get_delta(cleaned_id):
+    stored = db.session.get(CensusDelta, cleaned_id)
+    return json.loads(stored.summary_json) if stored else None
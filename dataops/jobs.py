@@ -0,0 +1,142 @@
+from dbmanager import db
+from .models import ProcessingJob, BlobOriginal
+from .pipeline import process_original
+from .metrics import PipelineTimer, record_pipeline, profiled
+from datetime import datetime, timedelta
+import os
+import threading
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", 5))
+JOB_STALE_MINUTES = int(os.getenv("JOB_STALE_MINUTES", 60))
+# A running job's lease is pushed forward every third of this while its worker is alive, it's requeued once it runs out
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", 120))
+# How far back the upload page lists a user's unfinished and failed jobs
+JOB_LIST_DAYS = int(os.getenv("JOB_LIST_DAYS", 7))
+
+# Set whenever a job is queued so idle workers don't wait out the poll interval
+_wake = threading.Event()
+
+# Queues a stored original for cleaning and returns the job row
+def enqueue_job(original):
+    job = ProcessingJob(
+        original_id=original.id,
+        filename=original.filename,
+        union=original.union,
+        email=original.email,
+        status="queued",
+        created_at=datetime.now()
+    )
+    db.session.add(job)
+    db.session.commit()
+    _wake.set()
+    return job
+
+# Status info for the /jobs endpoint
+def job_status(job):
+    return {
+        'id': job.id,
+        'filename': job.filename,
+        'status': job.status,
+        'error': job.error,
+        'cleaned_id': job.cleaned_id,
+        'created_at': job.created_at.strftime('%Y-%m-%d %H:%M:%S') if job.created_at else None,
+        'started_at': job.started_at.strftime('%Y-%m-%d %H:%M:%S') if job.started_at else None,
+        'finished_at': job.finished_at.strftime('%Y-%m-%d %H:%M:%S') if job.finished_at else None
+    }
+
+# A user's jobs that haven't produced a listed file yet (queued, running or failed) from the last JOB_LIST_DAYS, newest first
+def pending_jobs(email, limit=20):
+    since = datetime.now() - timedelta(days=JOB_LIST_DAYS)
+    jobs = ProcessingJob.query.filter(ProcessingJob.status.in_(("queued", "running", "failed")), ProcessingJob.email == email, ProcessingJob.created_at >= since) \
+        .order_by(ProcessingJob.id.desc()).limit(limit)
+    return [job_status(job) for job in jobs]
+
+# Takes the oldest queued job, SKIP LOCKED keeps workers in other processes from taking the same one
+def claim_job():
+    job = ProcessingJob.query.filter_by(status="queued").order_by(ProcessingJob.id).with_for_update(skip_locked=True).first()
+    if not job:
+        db.session.rollback()
+        return None
+    job.status = "running"
+    job.started_at = datetime.now()
+    job.lease_until = job.started_at + timedelta(seconds=JOB_LEASE_SECONDS)
+    db.session.commit()
+    return job.id
+
+# Keeps a running job's lease fresh until stopped, on its own connection so the pipeline's transaction is never touched
+def _heartbeat(engine, job_id, stop):
+    table = ProcessingJob.__table__
+    while not stop.wait(JOB_LEASE_SECONDS / 3):
+        try:
+            with engine.begin() as conn:
+                conn.execute(table.update().where(table.c.id == job_id, table.c.status == "running")
+                             .values(lease_until=datetime.now() + timedelta(seconds=JOB_LEASE_SECONDS)))
+        except Exception as e:
+            print(f"Job {job_id} heartbeat failed: {e}")
+
+# Runs the cleaning pipeline for one claimed job and records the outcome
+def run_job(job_id):
+    job = db.session.get(ProcessingJob, job_id)
+    timer = PipelineTimer('web', job.union)
+    stop = threading.Event()
+    threading.Thread(target=_heartbeat, args=(db.engine, job_id, stop), name=f"job-{job_id}-heartbeat", daemon=True).start()
+    try:
+        original = db.session.get(BlobOriginal, job.original_id)
+        with profiled(job.filename):
+            cleaned = process_original(original, timer)
+        job.cleaned_id = cleaned.id
+        job.status = "done"
+        record_pipeline(timer.finish("reused" if cleaned.reused else "done"))
+    except Exception as e:
+        record_pipeline(timer.finish("failed"))
+        print(f"Bad job {job_id}: {e}")
+        db.session.rollback()
+        job = db.session.get(ProcessingJob, job_id)
+        job.status = "failed"
+        job.error = str(e)
+    finally:
+        stop.set()
+    job.finished_at = datetime.now()
+    job.lease_until = None
+    db.session.commit()
+
+# Puts jobs whose worker died back in the queue: their lease ran out because nothing refreshed it
+# Jobs from before leases existed fall back to JOB_STALE_MINUTES since they started
+def requeue_stale_jobs():
+    now = datetime.now()
+    expired = (ProcessingJob.lease_until < now) | (ProcessingJob.lease_until.is_(None) & (ProcessingJob.started_at < now - timedelta(minutes=JOB_STALE_MINUTES)))
+    requeued = ProcessingJob.query.filter(ProcessingJob.status == "running", expired) \
+        .update({'status': "queued", 'started_at': None, 'lease_until': None}, synchronize_session=False)
+    db.session.commit()
+    if requeued:
+        print(f"Requeued {requeued} jobs with an expired lease")
+        _wake.set()
+
+def _worker_loop(app):
+    while True:
+        with app.app_context():
+            try:
+                job_id = claim_job()
+                if job_id is not None:
+                    run_job(job_id)
+                    continue
+                requeue_stale_jobs()
+            except Exception as e:
+                print(f"Job worker error: {e}")
+                db.session.rollback()
+        _wake.wait(JOB_POLL_SECONDS)
+        _wake.clear()
+
+# Starts the local worker pool as daemon threads
+def start_workers(app, count=None):
+    count = JOB_WORKERS if count is None else count
+    with app.app_context():
+        requeue_stale_jobs()
+    workers = []
+    for i in range(count):
+        worker = threading.Thread(target=_worker_loop, args=(app,), name=f"census-worker-{i}", daemon=True)
+        worker.start()
+        workers.append(worker)
+    print(f"JOB WORKERS: {count}")
+    return workers
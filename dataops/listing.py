@@ -0,0 +1,72 @@
+from .models import BlobCleaned
+from datetime import datetime
+import base64
+import json
+
+FILE_PAGE_MAX = 200
+
+# Sortable columns for the internal file listing, each has an index ending in (uploaded_at, id)
+# Pages are ordered by the full index, (column, uploaded_at, id), so the database reads them off it in order without a sort
+FILE_SORTS = {
+    'uploaded_at': BlobCleaned.uploaded_at,
+    'union': BlobCleaned.union,
+    'status': BlobCleaned.status,
+}
+
+def _sort_columns(sort):
+    column = FILE_SORTS[sort]
+    if sort == 'uploaded_at':
+        return [column, BlobCleaned.id]
+    return [column, BlobCleaned.uploaded_at, BlobCleaned.id]
+
+# Cursor holds the last row's value for every sort column, ValueError when it doesn't decode to that many
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values]).encode()).decode()
+
+def _decode_cursor(cursor, columns):
+    values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError("Bad page cursor")
+    return [datetime.fromisoformat(v) if c is BlobCleaned.uploaded_at and v is not None else v for c, v in zip(columns, values)]
+
+# Rows after the cursor in (c1, c2, ...) order: c1 past it, or c1 equal and the rest past it
+def _after(columns, values, descending):
+    column, value = columns[0], values[0]
+    past = column < value if descending else column > value
+    if len(columns) == 1:
+        return past
+    return past | ((column == value) & _after(columns[1:], values[1:], descending))
+
+# One page of cleaned file metadata, keyset paged so every page costs the same
+def list_cleaned_files(union=None, email=None, filename=None, sort='uploaded_at', order='desc', after=None, limit=25):
+    sort = sort if sort in FILE_SORTS else 'uploaded_at'
+    columns = _sort_columns(sort)
+    descending = order != 'asc'
+    limit = max(1, min(limit, FILE_PAGE_MAX))
+
+    query = BlobCleaned.query.with_entities(BlobCleaned.id, BlobCleaned.filename, BlobCleaned.union, BlobCleaned.email, BlobCleaned.uploaded_at, BlobCleaned.rowcount, BlobCleaned.status, BlobCleaned.invalid_rows) \
+        .filter(BlobCleaned.loaded.is_(True))
+    # Prefix matches so the filters can use the indexes
+    if union:
+        query = query.filter(BlobCleaned.union.startswith(union, autoescape=True))
+    if email:
+        query = query.filter(BlobCleaned.email.startswith(email, autoescape=True))
+    if filename:
+        query = query.filter(BlobCleaned.filename.startswith(filename, autoescape=True))
+    if after:
+        query = query.filter(_after(columns, _decode_cursor(after, columns), descending))
+    order_by = [c.desc() if descending else c.asc() for c in columns]
+    rows = query.order_by(*order_by).limit(limit + 1).all()
+
+    files = [{
+        'id': f.id,
+        'filename': f.filename,
+        'union': f.union,
+        'email': f.email,
+        'upload_date': f.uploaded_at.strftime('%Y-%m-%d %H:%M') if f.uploaded_at else '',
+        'rowcount': f.rowcount,
+        'status': f.status,
+        'invalid_rows': f.invalid_rows
+    } for f in rows[:limit]]
+    next_cursor = _encode_cursor([getattr(rows[limit - 1], c.key) for c in columns]) if len(rows) > limit else None
+    return {'files': files, 'next': next_cursor}
@@ -1,14 +1,65 @@
 from dbmanager import db
-from .models import Cleaned, UserLog
+from .models import Cleaned, StructuredLoad, BlobCleaned
+from .stats import record_upload
+from datetime import datetime
+import time
+import os
 
-# For inserting cleaned structured data
-def insert_cleaned_data(df):
-    rows = df.to_dict(orient='records')
-    db.session.bulk_insert_mappings(Cleaned, rows)
+STRUCTURED_BATCH_ROWS = int(os.getenv("STRUCTURED_BATCH_ROWS", 5000))
+
+# Columns of cleaned_structured that get filled from a cleaned census
+STRUCTURED_COLUMNS = [c.name for c in Cleaned.__table__.columns if c.name not in ('id', 'uploaded_at', 'cleaned_id')]
+
+def _batches(df, batch_size):
+    for offset in range(0, len(df), batch_size):
+        yield df.iloc[offset:offset + batch_size]
+
+# Streams a cleaned census into cleaned_structured, one executemany and commit per batch
+# df can also be an iterable of DataFrames, for censuses that never sit in memory whole
+# The cleaned file is only marked loaded (and counted in the upload stats) once every batch is in,
+# a failed load takes its rows back out and re-raises
+def load_structured(df, cleaned_id=None, batch_size=None):
+    batch_size = batch_size or STRUCTURED_BATCH_ROWS
+    start = time.perf_counter()
+    uploaded_at = datetime.now()
+    insert = Cleaned.__table__.insert()
+    frames = _batches(df, batch_size) if hasattr(df, 'iloc') else df
+
+    rows = 0
+    try:
+        for frame in frames:
+            names = {str(c).strip().lower().replace(' ', '_'): c for c in frame.columns}
+            columns = [c for c in STRUCTURED_COLUMNS if c in names]
+            batch = frame[[names[c] for c in columns]].astype(object)
+            batch = batch.where(batch.notna(), None)
+            records = [dict(zip(columns, values), uploaded_at=uploaded_at, cleaned_id=cleaned_id) for values in batch.itertuples(index=False, name=None)]
+            if records:
+                db.session.execute(insert, records)
+                db.session.commit()
+            rows += len(records)
+    except Exception:
+        db.session.rollback()
+        if cleaned_id is not None:
+            unload_structured(cleaned_id)
+        raise
+
+    seconds = time.perf_counter() - start
+    load = StructuredLoad(cleaned_id=cleaned_id, rows=rows, seconds=seconds, rows_per_second=rows / seconds if seconds else 0, loaded_at=datetime.now())
+    db.session.add(load)
+    if cleaned_id is not None:
+        marked = BlobCleaned.query.filter(BlobCleaned.id == cleaned_id, BlobCleaned.loaded.is_(False)).update({'loaded': True}, synchronize_session=False)
+        if marked:
+            upload = BlobCleaned.query.with_entities(BlobCleaned.email, BlobCleaned.union, BlobCleaned.uploaded_at, BlobCleaned.rowcount).filter(BlobCleaned.id == cleaned_id).one()
+            record_upload(upload.email, upload.union, upload.uploaded_at, upload.rowcount)
+    db.session.commit()
+    return load
+
+# Removes the rows a failed load got into cleaned_structured
+def unload_structured(cleaned_id):
+    removed = Cleaned.query.filter(Cleaned.cleaned_id == cleaned_id).delete(synchronize_session=False)
     db.session.commit()
+    print(f"Structured load of cleaned file {cleaned_id} failed, {removed} rows taken back out")
 
-# For inserting user l0gs
-def insert_log(user, file, action):
-    new_action = UserLog(user=user, file=file, action=action)
-    db.session.add(new_action)
-    db.session.commit()
\ No newline at end of file
+# For inserting cleaned structured data
+def insert_cleaned_data(df):
+    return load_structured(df)
@@ -0,0 +1,157 @@
+from dbmanager import db
+from .models import ColumnMapping
+from .metrics import PipelineTimer
+from censuscleaning import column_map_final
+from sqlalchemy.dialects import mysql, sqlite
+from datetime import datetime
+import pandas as pd
+import hashlib
+import json
+import time
+import os
+
+# Set to 0 to map every census's header row from scratch
+COLUMN_MAP_CACHE = os.getenv("COLUMN_MAP_CACHE", "1") != "0"
+
+def _normal(header):
+    return " ".join(str(header).split()).lower()
+
+# Same raw header row (ignoring case and spacing) gives the same fingerprint
+def header_fingerprint(columns):
+    return hashlib.sha256("\x1f".join(_normal(c) for c in columns).encode()).hexdigest()
+
+def _column_digest(series):
+    return hashlib.sha256(pd.util.hash_pandas_object(series.astype("string"), index=False).to_numpy().tobytes()).digest()
+
+# Works out which raw column each mapped column came from by comparing their values
+# Only a column with values that match exactly one raw column is learned. An empty mapped column says nothing about
+# where its data comes from in the next file, and a match with several raw columns is a guess. Either, or any column
+# column_map_final changed the values of, makes the layout not reusable and None is returned
+def learn_mapping(df, mapped):
+    if len(mapped) != len(df):
+        return None
+    sources = {}
+    for column in df.columns:
+        sources.setdefault(_column_digest(df[column]), []).append(column)
+    mapping = {}
+    for target in mapped.columns:
+        values = mapped[target].astype("string").str.strip()
+        if values.fillna("").eq("").all():
+            return None
+        found = sources.get(_column_digest(mapped[target]), [])
+        if len(found) != 1:
+            return None
+        mapping[str(target)] = str(found[0])
+    return mapping
+
+# Builds the mapped frame straight from a stored {standard column: raw header} mapping, KeyError if a header is missing
+def apply_mapping(df, mapping):
+    lookup = {_normal(c): c for c in df.columns}
+    return pd.DataFrame({
+        target: df[lookup[_normal(source)]] if source is not None else pd.Series(None, index=df.index, dtype=object)
+        for target, source in mapping.items()
+    }, index=df.index)
+
+def _store_learned(union, fingerprint, columns, mapping, infer_seconds):
+    values = {'union': union, 'fingerprint': fingerprint, 'headers_json': json.dumps([str(c) for c in columns]),
+              'mapping_json': json.dumps(mapping) if mapping is not None else None, 'source': 'learned',
+              'infer_seconds': infer_seconds, 'hits': 0, 'seconds_saved': 0, 'created_at': datetime.now()}
+    table = ColumnMapping.__table__
+    # Another worker may have learned the same layout since the lookup, the first one stays
+    if db.engine.dialect.name == 'sqlite':
+        stmt = sqlite.insert(table).values(**values).on_conflict_do_nothing(index_elements=['union', 'fingerprint'])
+    else:
+        stmt = mysql.insert(table).values(**values).prefix_with('IGNORE')
+    db.session.execute(stmt)
+    db.session.commit()
+    print(f"Column mapping {'learned' if mapping is not None else 'not reusable'} for {union}: {len(columns)} headers")
+
+# Mapped census columns, from the union's stored mapping for this header row when there is one and from
+# column_map_final otherwise. Time saved against the last inference for the layout goes on the timer and the stored row
+def map_columns(df, union=None, timer=None):
+    if not COLUMN_MAP_CACHE or not union:
+        return column_map_final(df.columns, df)
+    return resolve_mapping(df, union, timer)[0]
+
+# map_columns for the first part of a census, returning (mapped frame, mapping the rest can be mapped with or None)
+# The stored row is looked up, learned and counted once here, so a census read in chunks is one hit, not one per chunk
+def resolve_mapping(df, union=None, timer=None):
+    timer = timer or PipelineTimer(None, None)
+    if not COLUMN_MAP_CACHE or not union:
+        mapped = column_map_final(df.columns, df)
+        return mapped, learn_mapping(df, mapped)
+    start = time.perf_counter()
+    fingerprint = header_fingerprint(df.columns)
+    stored = ColumnMapping.query.filter_by(union=union, fingerprint=fingerprint).first()
+    if stored is not None and stored.mapping_json is not None:
+        mapping = json.loads(stored.mapping_json)
+        try:
+            mapped = apply_mapping(df, mapping)
+        except KeyError:
+            mapped = None
+        if mapped is not None:
+            saved = max(stored.infer_seconds - (time.perf_counter() - start), 0)
+            ColumnMapping.query.filter_by(id=stored.id).update({
+                'hits': ColumnMapping.hits + 1, 'seconds_saved': ColumnMapping.seconds_saved + saved, 'last_used_at': datetime.now()
+            }, synchronize_session=False)
+            db.session.commit()
+            timer.save('column_map', saved)
+            return mapped, mapping
+
+    start = time.perf_counter()
+    mapped = column_map_final(df.columns, df)
+    infer_seconds = time.perf_counter() - start
+    learned = learn_mapping(df, mapped)
+    if stored is None:
+        _store_learned(union, fingerprint, df.columns, learned, infer_seconds)
+    else:
+        ColumnMapping.query.filter_by(id=stored.id).update({'infer_seconds': infer_seconds, 'last_used_at': datetime.now()}, synchronize_session=False)
+        db.session.commit()
+    return mapped, learned
+
+def mapping_dict(row):
+    return {
+        'id': row.id, 'union': row.union, 'fingerprint': row.fingerprint, 'headers': json.loads(row.headers_json),
+        'mapping': json.loads(row.mapping_json) if row.mapping_json is not None else None, 'source': row.source,
+        'infer_seconds': round(row.infer_seconds, 4), 'hits': row.hits, 'seconds_saved': round(row.seconds_saved, 2),
+        'created_at': str(row.created_at) if row.created_at else None, 'updated_at': str(row.updated_at) if row.updated_at else None,
+        'updated_by': row.updated_by, 'last_used_at': str(row.last_used_at) if row.last_used_at else None,
+    }
+
+def list_mappings(union=None):
+    query = ColumnMapping.query.order_by(ColumnMapping.union, ColumnMapping.id)
+    if union:
+        query = query.filter(ColumnMapping.union == union)
+    return [mapping_dict(row) for row in query]
+
+# Admin override of a stored mapping, every raw header named has to be in that layout's header row
+# Returns (row, None) or (None, error message)
+def set_mapping(mapping_id, mapping, email):
+    row = db.session.get(ColumnMapping, mapping_id)
+    if row is None:
+        return None, "Mapping not found"
+    if not isinstance(mapping, dict) or not mapping:
+        return None, "Mapping must be an object of standard column -> raw header"
+    if not all(isinstance(target, str) and target.strip() for target in mapping):
+        return None, "Standard column names can't be blank"
+    headers = {_normal(h) for h in json.loads(row.headers_json)}
+    unknown = [str(source) for source in mapping.values() if source is not None and (not isinstance(source, str) or _normal(source) not in headers)]
+    if unknown:
+        return None, "Not in this layout's header row: " + ", ".join(unknown)
+    row.mapping_json = json.dumps(mapping)
+    row.source = 'admin'
+    row.updated_at = datetime.now()
+    row.updated_by = email
+    db.session.commit()
+    return row, None
+
+# Forgets a stored mapping, the union's next census with that header row is mapped from scratch and learned again
+# Returns what was deleted, None if there was no such mapping
+def delete_mapping(mapping_id):
+    row = db.session.get(ColumnMapping, mapping_id)
+    if row is None:
+        return None
+    deleted = mapping_dict(row)
+    db.session.delete(row)
+    db.session.commit()
+    return deleted
@@ -0,0 +1,91 @@
+from dbmanager import db
+from .models import Cleaned, BlobCleaned
+import base64
+import json
+
+MEMBER_PAGE_MAX = 500
+
+# Filters the search endpoint accepts
+MEMBER_FILTERS = ('email', 'last_name', 'first_name', 'dob', 'zip_code', 'organization', 'local', 'cleaned_id')
+# Filters that lead an index on cleaned_structured, a search needs at least one so it never scans the table
+MEMBER_LEADING_FILTERS = ('email', 'last_name', 'zip_code', 'organization', 'cleaned_id')
+# Columns of each index on cleaned_structured, the primary key (id) comes after them in every one
+MEMBER_INDEXES = (('email',), ('cleaned_id',), ('zip_code',), ('last_name', 'first_name', 'dob'), ('organization', 'local'))
+# Filters that are only in an index behind another column, (last_name, first_name, dob) and (organization, local)
+MEMBER_FILTER_NEEDS = {'first_name': 'last_name', 'dob': 'last_name', 'local': 'organization'}
+
+# Why a set of filters can't be served from an index, None when it can
+def member_filter_error(filters):
+    given = {name for name in MEMBER_FILTERS if filters.get(name) not in (None, '')}
+    missing = [f"{name} needs {MEMBER_FILTER_NEEDS[name]}" for name in MEMBER_FILTERS if name in given and name in MEMBER_FILTER_NEEDS and MEMBER_FILTER_NEEDS[name] not in given]
+    if missing:
+        return "; ".join(missing)
+    if not given & set(MEMBER_LEADING_FILTERS):
+        return "Give at least one of: " + ", ".join(MEMBER_LEADING_FILTERS)
+    return None
+
+# Page order for a filter set: the index columns after its equality-filtered prefix, then id, so the rows come off
+# the index already in order. An index whose every column is filtered is preferred, there the order is just id
+def member_sort(given):
+    best = None
+    for columns in MEMBER_INDEXES:
+        prefix = 0
+        while prefix < len(columns) and columns[prefix] in given:
+            prefix += 1
+        if prefix and (best is None or len(columns) - prefix < len(best)):
+            best = columns[prefix:]
+    return [getattr(Cleaned, name) for name in best or ()] + [Cleaned.id]
+
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+# ValueError when the cursor doesn't hold one value per sort column
+def _decode_cursor(cursor, columns):
+    values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError("Bad page cursor")
+    return values
+
+# Rows after the cursor in ascending (c1, c2, ...) order, NULLs sort first
+def _after(columns, values):
+    column, value = columns[0], values[0]
+    past, same = (column.isnot(None), column.is_(None)) if value is None else (column > value, column == value)
+    if len(columns) == 1:
+        return past
+    return past | (same & _after(columns[1:], values[1:]))
+
+# Keyset paged member search across every census, pass the returned next_after to get the following page
+def search_members(filters, after=None, limit=50):
+    limit = max(1, min(limit, MEMBER_PAGE_MAX))
+    query = db.session.query(Cleaned, BlobCleaned.filename, BlobCleaned.union).outerjoin(BlobCleaned, Cleaned.cleaned_id == BlobCleaned.id)
+    given = set()
+    for name in MEMBER_FILTERS:
+        value = filters.get(name)
+        if value not in (None, ''):
+            query = query.filter(getattr(Cleaned, name) == value)
+            given.add(name)
+    columns = member_sort(given)
+    if after:
+        query = query.filter(_after(columns, _decode_cursor(after, columns)))
+    rows = query.order_by(*columns).limit(limit + 1).all()
+
+    results = [{
+        'id': member.id,
+        'first_name': member.first_name,
+        'last_name': member.last_name,
+        'email': member.email,
+        'address_one': member.address_one,
+        'address_two': member.address_two,
+        'zip_code': member.zip_code,
+        'state': member.state,
+        'city': member.city,
+        'phone': member.phone,
+        'organization': member.organization,
+        'local': member.local,
+        'dob': member.dob,
+        'cleaned_id': member.cleaned_id,
+        'filename': filename,
+        'union': union
+    } for member, filename, union in rows[:limit]]
+    next_after = _encode_cursor([getattr(rows[limit - 1][0], c.key) for c in columns]) if len(rows) > limit else None
+    return {'results': results, 'next_after': next_after}
@@ -0,0 +1,307 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime
+import threading
+import tempfile
+import cProfile
+import hmac
+import atexit
+import json
+import time
+import os
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# Comma separated census filenames to run under cProfile, '*' profiles every one
+PROFILE_FILES = {f.strip() for f in os.getenv("PROFILE_FILES", "").split(",") if f.strip()}
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+ROW_BUCKETS = (1000, 10000, 50000, 100000, 250000, 500000, 1000000, 5000000)
+BYTE_BUCKETS = (2**20, 10 * 2**20, 50 * 2**20, 100 * 2**20, 500 * 2**20, 2**30)
+
+# Seconds between writes of a process's metrics to METRICS_DIR
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", 5))
+
+_lock = threading.Lock()
+_registry = []
+_flusher = {'pid': None, 'name': None}
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + '}'
+
+# Prometheus style counter, one value per label tuple
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.label_names = name, help, labels
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, labels=(), amount=1):
+        _ensure_flusher()
+        with _lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    @staticmethod
+    def merge(total, value):
+        return (total or 0) + value
+
+    def render(self, values=None):
+        values = self._values if values is None else values
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(self.label_names, labels)} {value}")
+        return lines
+
+# Prometheus style histogram with fixed buckets, one set of buckets per label tuple
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.label_names, self.buckets = name, help, labels, buckets
+        self._values = {}
+        _registry.append(self)
+
+    def observe(self, labels, value):
+        _ensure_flusher()
+        with _lock:
+            counts, total, count = self._values.get(labels, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[labels] = (counts, total + value, count + 1)
+
+    @staticmethod
+    def merge(total, value):
+        if total is None:
+            return (list(value[0]), value[1], value[2])
+        return ([a + b for a, b in zip(total[0], value[0])], total[1] + value[1], total[2] + value[2])
+
+    def render(self, values=None):
+        values = self._values if values is None else values
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.label_names + ('le',)
+        for labels, (counts, total, count) in sorted(values.items()):
+            for bound, hits in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_labels(names, labels + (bound,))} {hits}")
+            lines.append(f"{self.name}_bucket{_labels(names, labels + ('+Inf',))} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {count}")
+        return lines
+
+
+request_seconds = Histogram("census_http_request_seconds", "Request latency per Flask route", ('route', 'method', 'status'))
+stage_seconds = Histogram("census_stage_seconds", "Time spent in each census pipeline stage", ('stage', 'source', 'union'), STAGE_BUCKETS)
+file_rows = Histogram("census_file_rows", "Rows per processed census", ('source', 'union'), ROW_BUCKETS)
+file_bytes = Histogram("census_file_bytes", "Size of each processed census", ('source', 'union'), BYTE_BUCKETS)
+files_total = Counter("census_files_total", "Censuses processed", ('source', 'union', 'outcome'))
+rows_total = Counter("census_rows_total", "Census rows processed", ('source', 'union'))
+bytes_total = Counter("census_bytes_total", "Census bytes processed", ('source', 'union'))
+seconds_saved = Counter("census_seconds_saved_total", "Pipeline time skipped by cached results", ('stage', 'source', 'union'))
+
+# Scrapes must send METRICS_TOKEN as a bearer token. Without a token nobody is let in, unless METRICS_PUBLIC=1 opens it
+def metrics_allowed(authorization):
+    token = os.getenv("METRICS_TOKEN", "")
+    if token:
+        return hmac.compare_digest(authorization or "", f"Bearer {token}")
+    return os.getenv("METRICS_PUBLIC", "0") == "1"
+
+# Directory shared by the gunicorn workers (set by gunicorn.conf.py), read when called so the master's setting applies
+def metrics_dir():
+    return os.getenv("METRICS_DIR", "")
+
+RETIRED_FILE = "metrics-retired.json"
+
+def _write_state(folder, name, state):
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix=".part")
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, os.path.join(folder, name))
+
+def _read_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# Adds one file's values into {metric name: {labels: value}}
+def _add_state(merged, state):
+    for metric in _registry:
+        values = merged.setdefault(metric.name, {})
+        for labels, value in state.get(metric.name, []):
+            labels = tuple(labels)
+            values[labels] = metric.merge(values.get(labels), value)
+    return merged
+
+def _to_state(merged):
+    return {name: [[list(labels), value] for labels, value in values.items()] for name, values in merged.items()}
+
+# Shared lock for scrapes, exclusive while a worker moves its values into the retired totals, so no scrape counts them twice
+# fcntl is only imported here, the dev server on Windows never sets METRICS_DIR
+@contextmanager
+def _dir_lock(folder, exclusive):
+    import fcntl
+    with open(os.path.join(folder, "metrics.lock"), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _own_file():
+    if _flusher['name'] is None or not _flusher['name'].startswith(f"metrics-{os.getpid()}-"):
+        _flusher['name'] = f"metrics-{os.getpid()}-{time.time_ns()}.json"
+    return _flusher['name']
+
+# Writes this process's metric values to its own file in METRICS_DIR, replacing its previous file in one rename
+# The start time is in the name so a new worker that gets an old pid never writes over another worker's file
+def flush_metrics():
+    folder = metrics_dir()
+    if not folder or _flusher.get('retired'):
+        return
+    with _lock:
+        state = {metric.name: [[list(labels), value] for labels, value in metric._values.items()] for metric in _registry}
+    os.makedirs(folder, exist_ok=True)
+    _write_state(folder, _own_file(), state)
+
+# For gunicorn's worker_exit: adds this worker's values to the retired totals and removes its file, so counters
+# carry on rising across worker restarts while METRICS_DIR only holds the live workers' files and one totals file
+def retire_metrics():
+    folder = metrics_dir()
+    if not folder:
+        return
+    flush_metrics()
+    _flusher['retired'] = True
+    own = os.path.join(folder, _own_file())
+    with _dir_lock(folder, exclusive=True):
+        totals = _add_state(_add_state({}, _read_state(os.path.join(folder, RETIRED_FILE))), _read_state(own))
+        _write_state(folder, RETIRED_FILE, _to_state(totals))
+        os.remove(own)
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_SECONDS)
+        try:
+            flush_metrics()
+        except OSError as e:
+            print(f"Metrics flush failed: {e}")
+
+# Started lazily, so each gunicorn worker (forked after import) gets its own flush thread
+def _ensure_flusher():
+    if _flusher['pid'] == os.getpid() or not metrics_dir():
+        return
+    with _lock:
+        if _flusher['pid'] == os.getpid():
+            return
+        _flusher['pid'] = os.getpid()
+    threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True).start()
+    atexit.register(flush_metrics)
+
+# Live workers' values plus the retired totals, each live worker's file is at most METRICS_FLUSH_SECONDS behind
+def _merged_values():
+    flush_metrics()
+    folder = metrics_dir()
+    merged = {metric.name: {} for metric in _registry}
+    with _dir_lock(folder, exclusive=False):
+        for name in os.listdir(folder):
+            if name.startswith("metrics-") and name.endswith(".json"):
+                _add_state(merged, _read_state(os.path.join(folder, name)))
+    return merged
+
+# Text exposition for the /metrics endpoint, summed over every process writing to METRICS_DIR when it is set
+def render_metrics():
+    if metrics_dir():
+        merged = _merged_values()
+        lines = [line for metric in _registry for line in metric.render(merged[metric.name])]
+    else:
+        with _lock:
+            lines = [line for metric in _registry for line in metric.render()]
+    return "\n".join(lines) + "\n"
+
+# Serves render_metrics() on its own port, for processes that don't run the Flask app (the watcher)
+def start_metrics_server(port):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if not metrics_allowed(self.headers.get('Authorization')):
+                self.send_response(401)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = render_metrics().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"METRICS: port {port}")
+    return server
+
+# Per-stage timings for one census, tagged with where it came from and how big it was
+class PipelineTimer:
+    def __init__(self, source, union, size=0):
+        self.source, self.union, self.size = source, union, size
+        self.rows = 0
+        self.stages = {}
+        self.saved = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start
+
+    # Time a stage didn't need to spend, e.g. column mapping replayed from the union's stored mapping
+    def save(self, name, seconds):
+        self.saved[name] = self.saved.get(name, 0) + seconds
+
+    # Plain dict so timings from the SFTP worker processes can be sent back and recorded by the parent
+    def finish(self, outcome="done"):
+        self.stages['total'] = time.perf_counter() - self._start
+        return {'source': self.source, 'union': self.union, 'rows': self.rows, 'bytes': self.size, 'outcome': outcome, 'stages': dict(self.stages), 'saved': dict(self.saved)}
+
+# Adds one finished census to the metrics and prints a one line summary
+def record_pipeline(record):
+    source, union = record['source'], record['union']
+    for stage, seconds in record['stages'].items():
+        stage_seconds.observe((stage, source, union), seconds)
+    files_total.inc((source, union, record['outcome']))
+    if record['outcome'] == "done":
+        file_rows.observe((source, union), record['rows'])
+        file_bytes.observe((source, union), record['bytes'])
+        rows_total.inc((source, union), record['rows'])
+        bytes_total.inc((source, union), record['bytes'])
+    for stage, seconds in record.get('saved', {}).items():
+        seconds_saved.inc((stage, source, union), seconds)
+    stages = " ".join(f"{stage}={seconds:.2f}s" for stage, seconds in record['stages'].items())
+    saved = "".join(f" {stage}_saved={seconds:.2f}s" for stage, seconds in record.get('saved', {}).items())
+    print(f"Pipeline {source} {union}: {record['rows']} rows {record['bytes']} bytes {record['outcome']} {stages}{saved}")
+
+# Runs the block under cProfile when the census filename is listed in PROFILE_FILES
+# Only the calling thread is profiled, which is the one running the pipeline
+@contextmanager
+def profiled(filename):
+    if not (filename in PROFILE_FILES or '*' in PROFILE_FILES):
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{os.path.basename(filename)}-{datetime.now():%Y%m%d-%H%M%S}.prof")
+        profiler.dump_stats(path)
+        print(f"Profile saved: {path}")
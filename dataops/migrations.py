@@ -0,0 +1,93 @@
+from dbmanager import db
+from sqlalchemy import inspect, text
+from .stats import rebuild_upload_stats
+
+# Columns added to tables after they were first created, db.create_all() only builds missing tables
+NEW_COLUMNS = {
+    'blob_original': {'content_hash': 'VARCHAR(64) NULL'},
+    'blob_cleaned': {
+        'file_size': 'BIGINT NULL', 'content_hash': 'VARCHAR(64) NULL', 'parquet_blob': 'LONGBLOB NULL',
+        'parquet_hash': 'VARCHAR(64) NULL', 'source_hash': 'VARCHAR(64) NULL', 'reused': 'BOOLEAN NOT NULL DEFAULT 0',
+        'loaded': 'BOOLEAN NOT NULL DEFAULT 1',
+        'invalid_rows': 'INTEGER NULL', 'keys_hash': 'VARCHAR(64) NULL'
+    },
+    'cleaned_structured': {'cleaned_id': 'INTEGER NULL'},
+    'processing_jobs': {'lease_until': 'DATETIME NULL'},
+    'blob_content': {'codec': "VARCHAR(16) NOT NULL DEFAULT 'none'", 'stored_size': 'BIGINT NULL', 'archive_key': 'VARCHAR(255) NULL', 'archived_at': 'DATETIME NULL',
+                     'part_size': 'BIGINT NULL', 'tried_codec': 'VARCHAR(16) NULL'},
+}
+
+# Columns that became nullable, only MariaDB can relax these in place
+RELAXED_COLUMNS = {
+    'blob_cleaned': {'file_blob': 'LONGBLOB NULL'},
+    'blob_original': {'file_blob': 'LONGBLOB NULL'},
+}
+
+# Indexes on those columns as (name, table, columns)
+NEW_INDEXES = [
+    ('ix_blob_original_content_hash', 'blob_original', ['content_hash']),
+    ('ix_cleaned_structured_email', 'cleaned_structured', ['email']),
+    ('ix_cleaned_structured_name_dob', 'cleaned_structured', ['last_name', 'first_name', 'dob']),
+    ('ix_cleaned_structured_zip_code', 'cleaned_structured', ['zip_code']),
+    ('ix_cleaned_structured_org_local', 'cleaned_structured', ['organization', 'local']),
+    ('ix_cleaned_structured_cleaned_id', 'cleaned_structured', ['cleaned_id']),
+    ('ix_blob_cleaned_uploaded_at', 'blob_cleaned', ['uploaded_at', 'id']),
+    ('ix_blob_cleaned_union', 'blob_cleaned', ['union', 'uploaded_at', 'id']),
+    ('ix_blob_cleaned_email', 'blob_cleaned', ['email', 'uploaded_at', 'id']),
+    ('ix_blob_cleaned_status', 'blob_cleaned', ['status', 'uploaded_at', 'id']),
+    ('ix_blob_cleaned_filename', 'blob_cleaned', ['filename']),
+    ('ix_blob_cleaned_source_hash', 'blob_cleaned', ['source_hash']),
+    ('ix_user_log_user_timestamp', 'user_log', ['user', 'timestamp']),
+    ('ix_user_log_file', 'user_log', ['file']),
+]
+
+# Foreign keys on added columns as (name, table, column, referenced table), SQLite can't add these after the fact
+NEW_FOREIGN_KEYS = [
+    ('fk_cleaned_structured_cleaned_id', 'cleaned_structured', 'cleaned_id', 'blob_cleaned'),
+]
+
+# Unique email indexes on the whitelists as (name, table), duplicates are merged before these are built
+UNIQUE_EMAIL_INDEXES = [
+    ('uq_internal_whitelist_email', 'internal_whitelist'),
+    ('uq_external_whitelist_email', 'external_whitelist'),
+]
+
+# Keeps the oldest row per normalised email, then stores every email trimmed and lowercase
+def dedupe_whitelist_emails(conn, table):
+    conn.execute(text(
+        f"DELETE FROM {table} WHERE id NOT IN "
+        f"(SELECT keep_id FROM (SELECT MIN(id) AS keep_id FROM {table} GROUP BY LOWER(TRIM(email))) AS keep)"
+    ))
+    conn.execute(text(f"UPDATE {table} SET email = LOWER(TRIM(email)) WHERE email <> LOWER(TRIM(email))"))
+
+# Brings an existing database up to the current models, safe to run on every start
+def upgrade_schema():
+    backfill_stats = not inspect(db.engine).has_table('member_upload_stats')
+    db.create_all()
+    inspector = inspect(db.engine)
+    quote = db.engine.dialect.identifier_preparer.quote
+    with db.engine.begin() as conn:
+        for table, columns in NEW_COLUMNS.items():
+            existing = {c['name'] for c in inspector.get_columns(table)}
+            for name, ddl in columns.items():
+                if name not in existing:
+                    conn.execute(text(f"ALTER TABLE {quote(table)} ADD COLUMN {quote(name)} {ddl}"))
+        if db.engine.dialect.name in ('mysql', 'mariadb'):
+            for table, columns in RELAXED_COLUMNS.items():
+                nullable = {c['name']: c['nullable'] for c in inspector.get_columns(table)}
+                for name, ddl in columns.items():
+                    if not nullable.get(name, True):
+                        conn.execute(text(f"ALTER TABLE {quote(table)} MODIFY {quote(name)} {ddl}"))
+        for name, table, columns in NEW_INDEXES:
+            if name not in {i['name'] for i in inspector.get_indexes(table)}:
+                conn.execute(text(f"CREATE INDEX {quote(name)} ON {quote(table)} ({', '.join(quote(c) for c in columns)})"))
+        for name, table in UNIQUE_EMAIL_INDEXES:
+            if name not in {i['name'] for i in inspector.get_indexes(table)}:
+                dedupe_whitelist_emails(conn, quote(table))
+                conn.execute(text(f"CREATE UNIQUE INDEX {quote(name)} ON {quote(table)} ({quote('email')})"))
+        if db.engine.dialect.name in ('mysql', 'mariadb'):
+            for name, table, column, referred in NEW_FOREIGN_KEYS:
+                if not any(fk['constrained_columns'] == [column] for fk in inspector.get_foreign_keys(table)):
+                    conn.execute(text(f"ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(name)} FOREIGN KEY ({quote(column)}) REFERENCES {quote(referred)} (id)"))
+    if backfill_stats:
+        rebuild_upload_stats()
@@ -2,6 +2,11 @@
 
 from dbmanager import db
 from datetime import datetime
+from sqlalchemy.orm import deferred, validates
+
+# Whitelist emails are stored trimmed and lowercase so every lookup is a plain indexed equality
+def normalize_email(email):
+    return (email or "").strip().lower()
 
 # Clean DB model
 class Cleaned(db.Model):
@@ -21,8 +26,51 @@ class Cleaned(db.Model):
     local = db.Column(db.String(255), nullable=True)
     dob = db.Column(db.String(255), nullable=True)
     uploaded_at = db.Column(db.DateTime, default=datetime.now())
+    cleaned_id = db.Column(db.Integer, db.ForeignKey('blob_cleaned.id'), nullable=True)
+
+    # Lookup paths for cross-census member search, each also carries the PK for keyset paging
+    __table_args__ = (
+        db.Index('ix_cleaned_structured_email', 'email'),
+        db.Index('ix_cleaned_structured_name_dob', 'last_name', 'first_name', 'dob'),
+        db.Index('ix_cleaned_structured_zip_code', 'zip_code'),
+        db.Index('ix_cleaned_structured_org_local', 'organization', 'local'),
+        db.Index('ix_cleaned_structured_cleaned_id', 'cleaned_id'),
+    )
+
+# Content addressed file bytes, every BLOB row with the same sha256 points at one copy
+class BlobContent(db.Model):
+    __tablename__ = 'blob_content'
+
+    hash = db.Column(db.String(64), primary_key=True)
+    data = deferred(db.Column(db.LargeBinary(length=4294967295), nullable=False))
+    size = db.Column(db.BigInteger, nullable=False)
+    # data is compressed with codec, stored_size is its length in the table
+    codec = db.Column(db.String(16), nullable=False, default='none')
+    stored_size = db.Column(db.BigInteger, nullable=True)
+    # Codec last tried on the bytes, they stay in codec when that one didn't save enough
+    tried_codec = db.Column(db.String(16), nullable=True)
+    # Set once the bytes have moved to the object store, data is emptied then
+    archive_key = db.Column(db.String(255), nullable=True)
+    archived_at = db.Column(db.DateTime, nullable=True)
+    # Set when the bytes are in blob_content_parts instead of data
+    part_size = db.Column(db.BigInteger, nullable=True)
+    ref_count = db.Column(db.Integer, nullable=False, default=1)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+# One row per structured load of a cleaned census, for tracking load throughput
+class StructuredLoad(db.Model):
+    __tablename__ = 'structured_loads'
 
-# BLOB storage for cleaned DB
+    id = db.Column(db.Integer, primary_key=True)
+    cleaned_id = db.Column(db.Integer, db.ForeignKey('blob_cleaned.id'), nullable=True, index=True)
+    rows = db.Column(db.Integer, nullable=False)
+    seconds = db.Column(db.Float, nullable=False)
+    rows_per_second = db.Column(db.Float, nullable=False)
+    loaded_at = db.Column(db.DateTime, default=datetime.now)
+
+# BLOB storage for cleaned DB, blobs are deferred so entity queries only pull metadata
+# parquet_blob is the stored copy, file_blob (xlsx) is built from it on first download
+# New rows keep both in blob_content (parquet_hash / content_hash) and leave the inline columns empty
 class BlobCleaned(db.Model):
     __tablename__ = 'blob_cleaned'
 
@@ -30,13 +78,94 @@ class BlobCleaned(db.Model):
     filename = db.Column(db.String(255), nullable=False)
     union = db.Column(db.String(255), nullable=False)
     email = db.Column(db.String(255), nullable=False)
-    file_blob = db.Column(db.LargeBinary(length=4294967295), nullable=False)
+    file_blob = deferred(db.Column(db.LargeBinary(length=4294967295), nullable=True), group='payload')
+    parquet_blob = deferred(db.Column(db.LargeBinary(length=4294967295), nullable=True), group='columnar')
     file_type = db.Column(db.String(50), nullable=False)
     uploaded_at = db.Column(db.DateTime, default=datetime.now())
     rowcount = db.Column(db.String(255), nullable=False)
     status = db.Column(db.String(255), nullable=False, default="0")
+    file_size = db.Column(db.BigInteger, nullable=True)
+    content_hash = db.Column(db.String(64), nullable=True)
+    parquet_hash = db.Column(db.String(64), nullable=True)
+    source_hash = db.Column(db.String(64), nullable=True, index=True)
+    reused = db.Column(db.Boolean, nullable=False, default=False)
+    # False until every structured row is in, files that never finished loading aren't listed or reused
+    loaded = db.Column(db.Boolean, nullable=False, default=True)
+    # Rows failing at least one data quality check, None for files cleaned before the checks existed
+    invalid_rows = db.Column(db.Integer, nullable=True)
+    # Member keys and row hashes (parquet in blob_content) used to diff against the union's next census
+    keys_hash = db.Column(db.String(64), nullable=True)
+
+    # Keyset paging and filters for the internal file listing
+    __table_args__ = (
+        db.Index('ix_blob_cleaned_uploaded_at', 'uploaded_at', 'id'),
+        db.Index('ix_blob_cleaned_union', 'union', 'uploaded_at', 'id'),
+        db.Index('ix_blob_cleaned_email', 'email', 'uploaded_at', 'id'),
+        db.Index('ix_blob_cleaned_status', 'status', 'uploaded_at', 'id'),
+        db.Index('ix_blob_cleaned_filename', 'filename'),
+    )
+
+# First rows of a cleaned census as JSON so previews never re-read the workbook
+class BlobPreview(db.Model):
+    __tablename__ = 'blob_preview'
+
+    cleaned_id = db.Column(db.Integer, db.ForeignKey('blob_cleaned.id'), primary_key=True)
+    preview_json = db.Column(db.Text(length=16777215), nullable=False)
+    row_count = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+# Data quality report of a cleaned census, invalid counts per field with sample rows
+class BlobQuality(db.Model):
+    __tablename__ = 'blob_quality'
+
+    cleaned_id = db.Column(db.Integer, db.ForeignKey('blob_cleaned.id'), primary_key=True)
+    report_json = db.Column(db.Text, nullable=False)
+    invalid_rows = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+# What changed in a union's census since its previous one, counts plus sample members
+class CensusDelta(db.Model):
+    __tablename__ = 'census_deltas'
+
+    cleaned_id = db.Column(db.Integer, db.ForeignKey('blob_cleaned.id'), primary_key=True)
+    previous_id = db.Column(db.Integer, db.ForeignKey('blob_cleaned.id'), nullable=False)
+    added = db.Column(db.Integer, nullable=False)
+    changed = db.Column(db.Integer, nullable=False)
+    removed = db.Column(db.Integer, nullable=False)
+    unchanged = db.Column(db.Integer, nullable=False)
+    summary_json = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+# Content too big for one statement, stored as numbered parts of BlobContent.part_size bytes (the last one shorter)
+class BlobContentPart(db.Model):
+    __tablename__ = 'blob_content_parts'
+
+    hash = db.Column(db.String(64), primary_key=True)
+    part = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    data = deferred(db.Column(db.LargeBinary(length=4294967295), nullable=False))
+
+# Header mapping learned (or set by an admin) for one union's census layout, keyed by a fingerprint of the raw header row
+# mapping_json is {standard column: raw header}, null when the layout couldn't be learned and is mapped from scratch every time
+class ColumnMapping(db.Model):
+    __tablename__ = 'column_mappings'
+
+    id = db.Column(db.Integer, primary_key=True)
+    union = db.Column(db.String(255), nullable=False)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    headers_json = db.Column(db.Text, nullable=False)
+    mapping_json = db.Column(db.Text, nullable=True)
+    source = db.Column(db.String(20), nullable=False, default="learned")
+    infer_seconds = db.Column(db.Float, nullable=False, default=0)
+    hits = db.Column(db.Integer, nullable=False, default=0)
+    seconds_saved = db.Column(db.Float, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, nullable=True)
+    updated_by = db.Column(db.String(255), nullable=True)
+    last_used_at = db.Column(db.DateTime, nullable=True)
 
-# BLOB storage DB model for original data
+    __table_args__ = (db.Index('uq_column_mappings_union_fingerprint', 'union', 'fingerprint', unique=True),)
+
+# BLOB storage DB model for original data, new rows keep their bytes in blob_content under content_hash
 class BlobOriginal(db.Model):
     __tablename__ = 'blob_original'
 
@@ -44,9 +173,29 @@ class BlobOriginal(db.Model):
     filename = db.Column(db.String(255), nullable=False)
     union = db.Column(db.String(255), nullable=False)
     email = db.Column(db.String(255), nullable=False)
-    file_blob = db.Column(db.LargeBinary(length=4294967295), nullable=False)
+    file_blob = deferred(db.Column(db.LargeBinary(length=4294967295), nullable=True), group='payload')
     file_type = db.Column(db.String(50), nullable=False)
     uploaded_at = db.Column(db.DateTime, default=datetime.now())
+    content_hash = db.Column(db.String(64), nullable=True, index=True)
+
+# Upload totals per uploader email, kept up to date as cleaned files are stored
+class MemberUploadStats(db.Model):
+    __tablename__ = 'member_upload_stats'
+
+    email = db.Column(db.String(255), primary_key=True)
+    union = db.Column(db.String(255), nullable=False)
+    last_upload = db.Column(db.DateTime, nullable=True)
+    file_count = db.Column(db.Integer, nullable=False, default=0)
+    total_rows = db.Column(db.BigInteger, nullable=False, default=0)
+
+# Upload totals per union, kept up to date as cleaned files are stored
+class UnionUploadStats(db.Model):
+    __tablename__ = 'union_upload_stats'
+
+    union = db.Column(db.String(255), primary_key=True)
+    last_upload = db.Column(db.DateTime, nullable=True)
+    file_count = db.Column(db.Integer, nullable=False, default=0)
+    total_rows = db.Column(db.BigInteger, nullable=False, default=0)
 
 # Storage for internal users whitelist
 class InternalUsers(db.Model):
@@ -58,6 +207,12 @@ class InternalUsers(db.Model):
     email = db.Column(db.String(255), nullable=False)
     uploaded_at = db.Column(db.DateTime, default=datetime.now())
 
+    __table_args__ = (db.Index('uq_internal_whitelist_email', 'email', unique=True),)
+
+    @validates('email')
+    def _normalize_email(self, key, email):
+        return normalize_email(email)
+
 # Storage for internal users whitelist
 class ExternalUsers(db.Model):
     __tablename__ = 'external_whitelist'
@@ -69,6 +224,19 @@ class ExternalUsers(db.Model):
     union = db.Column(db.String(255), nullable=False)
     uploaded_at = db.Column(db.DateTime, default=datetime.now())
 
+    __table_args__ = (db.Index('uq_external_whitelist_email', 'email', unique=True),)
+
+    @validates('email')
+    def _normalize_email(self, key, email):
+        return normalize_email(email)
+
+# Single row counter bumped on every whitelist change, so each worker process knows to drop its cached roles
+class WhitelistVersion(db.Model):
+    __tablename__ = 'whitelist_version'
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
 # Storage for logging actions by internal users
 class UserLog(db.Model):
     __tablename__ = 'user_log'
@@ -77,4 +245,27 @@ class UserLog(db.Model):
     user = db.Column(db.String(255), nullable=False)
     file = db.Column(db.String(255), nullable=False)
     action = db.Column(db.String(255), nullable=False)
-    timestamp = db.Column(db.DateTime, default=datetime.now())
\ No newline at end of file
+    timestamp = db.Column(db.DateTime, default=datetime.now)
+
+    __table_args__ = (
+        db.Index('ix_user_log_user_timestamp', 'user', 'timestamp'),
+        db.Index('ix_user_log_file', 'file'),
+    )
+
+# Queue of uploaded census files waiting on the cleaning pipeline
+class ProcessingJob(db.Model):
+    __tablename__ = 'processing_jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    original_id = db.Column(db.Integer, db.ForeignKey('blob_original.id'), nullable=False)
+    cleaned_id = db.Column(db.Integer, db.ForeignKey('blob_cleaned.id'), nullable=True)
+    filename = db.Column(db.String(255), nullable=False)
+    union = db.Column(db.String(255), nullable=False)
+    email = db.Column(db.String(255), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default="queued", index=True)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    # Refreshed by the running worker, a running job past its lease belongs to a dead worker
+    lease_until = db.Column(db.DateTime, nullable=True)
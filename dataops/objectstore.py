@@ -0,0 +1,66 @@
+import tempfile
+import os
+
+# Directory holding archived blobs, keys are laid out like bucket object names so a MinIO/S3 store can take its place
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+
+# Object store on the local filesystem, one file per key
+class LocalObjectStore:
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    # Writes the chunks to a temporary file and renames it into place, so a key is either complete or missing
+    # With expected_size the file is only kept when that many bytes arrived, an existing object is never replaced by a short one
+    def put(self, key, chunks, expected_size=None):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        written = 0
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    written += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            if expected_size is not None and written != expected_size:
+                os.remove(tmp)
+                return written
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return written
+
+    def get(self, key):
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+    # Bytes start..end (inclusive) of an object one chunk at a time
+    def iter_range(self, key, start, end, chunk_size):
+        with open(self._path(key), 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def size(self, key):
+        return os.path.getsize(self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+object_store = LocalObjectStore(ARCHIVE_DIR)
+
+def content_key(content_hash):
+    return f"blob_content/{content_hash[:2]}/{content_hash}"
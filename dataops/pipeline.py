@@ -0,0 +1,208 @@
+from censuscleaning import load_file, clean_items, remove_dupes, column_map_final
+from .blob import clean_blob_parquet, to_parquet_bytes, copy_cleaned, find_cleaned_by_source, original_bytes, original_size, copy_original_to, PARQUET_COMPRESSION
+from .preview import save_preview, copy_preview, PREVIEW_MAX_ROWS
+from .loader import load_structured, STRUCTURED_BATCH_ROWS
+from .metrics import PipelineTimer
+from .quality import quality_report, merge_quality, save_quality, copy_quality
+from .delta import key_index, index_bytes, record_delta
+from .mapping import map_columns, resolve_mapping, apply_mapping
+import pyarrow.parquet as pq
+import pyarrow as pa
+import pandas as pd
+import numpy as np
+import tempfile
+import csv
+import io
+import os
+
+# File types load_file can read, anything else is turned away before it is stored
+CENSUS_FILE_TYPES = ('csv', 'xlsx', 'xls', 'txt')
+CLEAN_CHUNK_ROWS = int(os.getenv("CLEAN_CHUNK_ROWS", 100000))
+STREAM_MIN_BYTES = int(os.getenv("STREAM_MIN_BYTES", 50 * 1024 * 1024))
+
+# Column mapping, cleaning and dedupe on a loaded census, with the union's stored header mapping reused when it has one
+def clean_census(df, timer=None, union=None):
+    timer = timer or PipelineTimer(None, None)
+    with timer.stage('column_map'):
+        column_mapped_df = map_columns(df, union, timer)
+    return _clean_mapped(column_mapped_df, timer)
+
+def _clean_mapped(column_mapped_df, timer):
+    with timer.stage('clean'):
+        cleaned_df = clean_items(column_mapped_df)
+    with timer.stage('dedupe'):
+        return remove_dupes(cleaned_df)
+
+# Maps a later chunk of a streamed census the way the first chunk was mapped
+# column_map_final looks at the values, so without a replayable mapping each chunk is inferred and has to come out
+# with the first chunk's columns, a chunk that maps differently is an error rather than a column of blanks
+def _map_like_first(chunk, mapping, columns):
+    mapped = apply_mapping(chunk, mapping) if mapping is not None else column_map_final(chunk.columns, chunk)
+    if list(mapped.columns) != columns:
+        raise ValueError(f"Chunk mapped to different columns than the first chunk: {list(mapped.columns)} vs {columns}")
+    return mapped
+
+# Saves a cleaned census (parquet, excel built lazily) with its preview rows and structured records
+def store_cleaned(filename, union, email, cleaned_df, rowcount, source_hash=None, timer=None):
+    timer = timer or PipelineTimer(None, None)
+    timer.rows = rowcount
+    with timer.stage('validate'):
+        report = quality_report(cleaned_df)
+    with timer.stage('serialise'):
+        parquet_blob = to_parquet_bytes(cleaned_df)
+    with timer.stage('blob_insert'):
+        cleaned = clean_blob_parquet(filename, union, email, parquet_blob, rowcount, source_hash)
+        save_quality(cleaned.id, report)
+    with timer.stage('preview'):
+        save_preview(cleaned.id, cleaned_df)
+    # Against the union's previous census only added and changed members are loaded
+    with timer.stage('delta'):
+        changed = record_delta(cleaned, index_bytes(key_index(cleaned_df)))
+    with timer.stage('structured_load'):
+        load = load_structured(cleaned_df if changed is None else cleaned_df[changed], cleaned.id)
+    print(f"Structured load: {cleaned.filename} {load.rows} rows at {load.rows_per_second:.0f} rows/s")
+    return cleaned
+
+# Identical originals were already cleaned once, so share that result instead of cleaning again
+# Structured rows aren't loaded a second time, they are already in cleaned_structured under the earlier file
+def reuse_cleaned(original):
+    previous = find_cleaned_by_source(original.content_hash)
+    if not previous:
+        return None
+    cleaned = copy_cleaned(previous, original.filename, original.union, original.email)
+    copy_preview(previous.id, cleaned.id)
+    copy_quality(previous.id, cleaned.id)
+    print(f"Reused cleaned result: {original.filename} (same content as cleaned file {previous.id})")
+    return cleaned
+
+# Keeps only the rows of each batch that the mask (over the whole census) selects
+def _masked(frames, mask):
+    offset = 0
+    for frame in frames:
+        yield frame[mask[offset:offset + len(frame)]]
+        offset += len(frame)
+
+# Delimited censuses big enough to be cleaned chunk by chunk instead of loaded whole
+def should_stream(file_type, size):
+    return file_type in ('csv', 'txt') and size >= STREAM_MIN_BYTES
+
+# Reads a csv/txt census CLEAN_CHUNK_ROWS rows at a time, txt delimiters are sniffed from the header
+def read_chunks(path, file_type):
+    sep = ','
+    if file_type == 'txt':
+        with open(path, newline='', errors='replace') as f:
+            try:
+                sep = csv.Sniffer().sniff(f.readline(), delimiters=',\t|;').delimiter
+            except csv.Error:
+                sep = '\t'
+    return pd.read_csv(path, sep=sep, dtype=str, chunksize=CLEAN_CHUNK_ROWS)
+
+# Cleans a large census chunk by chunk, memory is bounded by the chunk size rather than the file
+# Rows repeated across chunks are dropped by their 64-bit row hash, kept in one sorted numpy array
+# Cleaned chunks are spooled to a parquet file on disk, then stored and loaded from there in batches
+def stream_clean(path, file_type, filename, union, email, source_hash=None, timer=None):
+    timer = timer or PipelineTimer(None, None)
+    seen = np.empty(0, dtype=np.uint64)
+    mapping = None
+    mapped_columns = None
+    columns = None
+    writer = None
+    index_writer = None
+    rowcount = 0
+    head = []
+    head_rows = 0
+    report = None
+
+    with tempfile.TemporaryFile() as spool, tempfile.TemporaryFile() as index_spool:
+        chunks = read_chunks(path, file_type)
+        while True:
+            with timer.stage('load'):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            rowcount += len(chunk)
+            # The mapping is worked out once, on the first chunk, and every later chunk is mapped the same way
+            with timer.stage('column_map'):
+                if mapped_columns is None:
+                    mapped, mapping = resolve_mapping(chunk, union, timer)
+                    mapped_columns = list(mapped.columns)
+                else:
+                    mapped = _map_like_first(chunk, mapping, mapped_columns)
+            cleaned_chunk = _clean_mapped(mapped, timer)
+            if columns is None:
+                columns = list(cleaned_chunk.columns)
+            elif set(cleaned_chunk.columns) != set(columns):
+                raise ValueError(f"Chunk cleaned to different columns than the first chunk: {list(cleaned_chunk.columns)} vs {columns}")
+            # Same column order and all-string types for every chunk so the parquet schema never changes
+            cleaned_chunk = cleaned_chunk[columns].astype("string")
+
+            with timer.stage('dedupe'):
+                keys = pd.util.hash_pandas_object(cleaned_chunk, index=False).to_numpy()
+                fresh = ~pd.Series(keys).duplicated().to_numpy() & ~np.isin(keys, seen)
+                cleaned_chunk = cleaned_chunk[fresh]
+                seen = np.union1d(seen, keys[fresh])
+
+            with timer.stage('validate'):
+                report = merge_quality(report, quality_report(cleaned_chunk, offset=report['rows'] if report else 0))
+
+            with timer.stage('serialise'):
+                table = pa.Table.from_pandas(cleaned_chunk, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(spool, table.schema, compression=PARQUET_COMPRESSION)
+                writer.write_table(table)
+
+            with timer.stage('delta'):
+                key_table = pa.Table.from_pandas(key_index(cleaned_chunk), preserve_index=False)
+                if index_writer is None:
+                    index_writer = pq.ParquetWriter(index_spool, key_table.schema, compression=PARQUET_COMPRESSION)
+                index_writer.write_table(key_table)
+
+            if head_rows < PREVIEW_MAX_ROWS:
+                head.append(cleaned_chunk.head(PREVIEW_MAX_ROWS - head_rows))
+                head_rows += len(head[-1])
+
+        if writer is None:
+            raise ValueError(f"No rows in {filename}")
+        with timer.stage('serialise'):
+            writer.close()
+        timer.rows = rowcount
+
+        spool.seek(0)
+        with timer.stage('blob_insert'):
+            cleaned = clean_blob_parquet(filename, union, email, spool, rowcount, source_hash)
+            save_quality(cleaned.id, report)
+        with timer.stage('preview'):
+            save_preview(cleaned.id, pd.concat(head))
+
+        with timer.stage('delta'):
+            index_writer.close()
+            index_spool.seek(0)
+            changed = record_delta(cleaned, index_spool.read())
+
+        spool.seek(0)
+        batches = (batch.to_pandas() for batch in pq.ParquetFile(spool).iter_batches(batch_size=STRUCTURED_BATCH_ROWS))
+        if changed is not None:
+            batches = _masked(batches, changed)
+        with timer.stage('structured_load'):
+            load = load_structured(batches, cleaned.id)
+
+    print(f"Streamed clean: {cleaned.filename} {rowcount} rows in, {len(seen)} unique rows out, loaded at {load.rows_per_second:.0f} rows/s")
+    return cleaned
+
+# Full pipeline for a stored original: load, clean, and save the cleaned BLOB
+def process_original(original, timer=None):
+    timer = timer or PipelineTimer(None, None)
+    reused = reuse_cleaned(original)
+    if reused:
+        return reused
+    timer.size = original_size(original)
+    if should_stream(original.file_type, timer.size):
+        # Spool the original to disk in chunks so neither the raw bytes nor the frame are held whole
+        with tempfile.NamedTemporaryFile(suffix='.' + original.file_type) as raw:
+            with timer.stage('load'):
+                copy_original_to(original, raw)
+            return stream_clean(raw.name, original.file_type, original.filename, original.union, original.email, original.content_hash, timer)
+    with timer.stage('load'):
+        df = load_file(original.file_type, io.BytesIO(original_bytes(original)))
+    cleaned_df = clean_census(df, timer, original.union)
+    return store_cleaned(original.filename, original.union, original.email, cleaned_df, len(df), original.content_hash, timer)
@@ -0,0 +1,80 @@
+from dbmanager import db
+from .models import BlobPreview
+from .blob import cleaned_blob_meta, load_cleaned_frame
+from collections import OrderedDict
+from datetime import datetime
+import pandas as pd
+import threading
+import json
+import math
+import os
+
+PREVIEW_MAX_ROWS = int(os.getenv("PREVIEW_MAX_ROWS", 500))
+PREVIEW_PAGE_ROWS = int(os.getenv("PREVIEW_PAGE_ROWS", 10))
+PREVIEW_CACHE_SIZE = int(os.getenv("PREVIEW_CACHE_SIZE", 64))
+
+# Small thread safe LRU, oldest entry is evicted once max_size is reached
+class LRUCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+_previews = LRUCache(PREVIEW_CACHE_SIZE)
+
+# Stores the first PREVIEW_MAX_ROWS rows of a cleaned census, called when the file is cleaned
+def save_preview(cleaned_id, df):
+    head = df.head(PREVIEW_MAX_ROWS)
+    preview = json.loads(head.to_json(orient='split', index=False, date_format='iso'))
+    db.session.merge(BlobPreview(cleaned_id=cleaned_id, preview_json=json.dumps(preview), row_count=len(head), created_at=datetime.now()))
+    db.session.commit()
+    _previews.put(cleaned_id, preview)
+    return preview
+
+# Shares the stored preview of an identical earlier census with a new cleaned row
+def copy_preview(from_id, to_id):
+    stored = db.session.get(BlobPreview, from_id)
+    if not stored:
+        return None
+    db.session.merge(BlobPreview(cleaned_id=to_id, preview_json=stored.preview_json, row_count=stored.row_count, created_at=datetime.now()))
+    db.session.commit()
+    return stored
+
+# Cached preview for a cleaned file, built once from the stored file for files cleaned before previews were stored
+def get_preview(cleaned_id):
+    preview = _previews.get(cleaned_id)
+    if preview is not None:
+        return preview
+    stored = db.session.get(BlobPreview, cleaned_id)
+    if stored:
+        preview = json.loads(stored.preview_json)
+        _previews.put(cleaned_id, preview)
+        return preview
+    if not cleaned_blob_meta(cleaned_id):
+        return None
+    return save_preview(cleaned_id, load_cleaned_frame(cleaned_id, nrows=PREVIEW_MAX_ROWS))
+
+# One page of preview rows as a DataFrame plus the number of pages available
+def preview_page(preview, page):
+    pages = max(1, math.ceil(len(preview['data']) / PREVIEW_PAGE_ROWS))
+    page = min(max(page, 1), pages)
+    rows = preview['data'][(page - 1) * PREVIEW_PAGE_ROWS:page * PREVIEW_PAGE_ROWS]
+    return pd.DataFrame(rows, columns=preview['columns']), page, pages
@@ -0,0 +1,94 @@
+from dbmanager import db
+from .models import BlobQuality, BlobCleaned
+from datetime import datetime
+import pandas as pd
+import numpy as np
+import json
+import os
+
+QUALITY_SAMPLE_ROWS = int(os.getenv("QUALITY_SAMPLE_ROWS", 5))
+
+US_STATES = {
+    'AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'FL', 'GA', 'HI', 'ID', 'IL', 'IN', 'IA', 'KS', 'KY', 'LA', 'ME', 'MD',
+    'MA', 'MI', 'MN', 'MS', 'MO', 'MT', 'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC', 'ND', 'OH', 'OK', 'OR', 'PA', 'RI', 'SC',
+    'SD', 'TN', 'TX', 'UT', 'VT', 'VA', 'WA', 'WV', 'WI', 'WY', 'DC', 'PR', 'GU', 'VI', 'AS', 'MP'
+}
+
+# Cleaned column -> (check, argument), columns a census doesn't have are skipped
+QUALITY_CHECKS = {
+    'email': ('pattern', r'[^@\s]+@[^@\s]+\.[A-Za-z]{2,}'),
+    'zip_code': ('pattern', r'\d{5}(-?\d{4})?'),
+    'phone': ('phone', None),
+    'dob': ('date', None),
+    'state': ('choices', US_STATES),
+}
+
+# Invalid flags for the non-blank values of one column, every check is a single vectorised pass
+def _invalid(check, arg, values):
+    if check == 'pattern':
+        return ~values.str.fullmatch(arg)
+    if check == 'phone':
+        digits = values.str.replace(r'\D', '', regex=True)
+        length = digits.str.len()
+        return ~((length == 10) | ((length == 11) & digits.str.startswith('1')))
+    if check == 'choices':
+        return ~values.str.upper().isin(arg)
+    parsed = values if pd.api.types.is_datetime64_any_dtype(values) else pd.to_datetime(values, errors='coerce')
+    return parsed.isna() | (parsed < pd.Timestamp(1900, 1, 1)) | (parsed > pd.Timestamp.now())
+
+# Missing and invalid counts per checked field, with a few offending rows for each
+# Row numbers are 1-based positions in the cleaned file, offset is for chunks after the first
+def quality_report(df, offset=0):
+    bad_rows = np.zeros(len(df), dtype=bool)
+    fields = {}
+    for column, (check, arg) in QUALITY_CHECKS.items():
+        if column not in df.columns:
+            continue
+        series = df[column].reset_index(drop=True)
+        if pd.api.types.is_datetime64_any_dtype(series):
+            blank = series.isna()
+            values = series[~blank]
+        else:
+            text = series.astype("string[pyarrow]").str.strip()
+            blank = text.fillna("").eq("").to_numpy(dtype=bool)
+            values = text[~blank]
+        invalid = _invalid(check, arg, values).fillna(True).to_numpy(dtype=bool)
+        positions = values.index.to_numpy()[invalid]
+        bad_rows[positions] = True
+        fields[column] = {
+            'missing': int(np.count_nonzero(blank)),
+            'invalid': int(len(positions)),
+            'samples': [{'row': int(p) + offset + 1, 'value': str(v)} for p, v in zip(positions[:QUALITY_SAMPLE_ROWS], values[invalid][:QUALITY_SAMPLE_ROWS])]
+        }
+    return {'rows': len(df), 'invalid_rows': int(np.count_nonzero(bad_rows)), 'fields': fields}
+
+# Adds a chunk's report to the running one for a census cleaned in chunks
+def merge_quality(total, part):
+    if total is None:
+        return part
+    total['rows'] += part['rows']
+    total['invalid_rows'] += part['invalid_rows']
+    for column, counts in part['fields'].items():
+        field = total['fields'].setdefault(column, {'missing': 0, 'invalid': 0, 'samples': []})
+        field['missing'] += counts['missing']
+        field['invalid'] += counts['invalid']
+        field['samples'] = (field['samples'] + counts['samples'])[:QUALITY_SAMPLE_ROWS]
+    return total
+
+# Stores the report next to the cleaned row, the invalid row count also goes on blob_cleaned for the listing
+def save_quality(cleaned_id, report):
+    db.session.merge(BlobQuality(cleaned_id=cleaned_id, report_json=json.dumps(report), invalid_rows=report['invalid_rows'], created_at=datetime.now()))
+    BlobCleaned.query.filter_by(id=cleaned_id).update({'invalid_rows': report['invalid_rows']}, synchronize_session=False)
+    db.session.commit()
+    return report
+
+# Shares the report of an identical earlier census with a new cleaned row
+def copy_quality(from_id, to_id):
+    report = get_quality(from_id)
+    if report is not None:
+        save_quality(to_id, report)
+    return report
+
+def get_quality(cleaned_id):
+    stored = db.session.get(BlobQuality, cleaned_id)
+    return json.loads(stored.report_json) if stored else None
@@ -0,0 +1,73 @@
+from dbmanager import db
+from .models import BlobCleaned, MemberUploadStats, UnionUploadStats, normalize_email
+from sqlalchemy import func, cast, Integer
+from sqlalchemy.dialects import mysql, sqlite
+
+def _fmt(when):
+    return when.strftime('%Y-%m-%d %H:%M') if when else None
+
+def _rows(rowcount):
+    try:
+        return int(rowcount)
+    except (TypeError, ValueError):
+        return 0
+
+# Insert or bump one stats row in a single statement, so concurrent uploads can't lose counts
+def _upsert(model, keys, extra, uploaded_at, rows):
+    table = model.__table__
+    values = {**keys, **extra, 'last_upload': uploaded_at, 'file_count': 1, 'total_rows': rows}
+    if db.engine.dialect.name == 'sqlite':
+        stmt = sqlite.insert(table).values(**values)
+        stmt = stmt.on_conflict_do_update(index_elements=list(keys), set_={
+            **{name: stmt.excluded[name] for name in extra},
+            'last_upload': func.max(func.coalesce(table.c.last_upload, stmt.excluded.last_upload), stmt.excluded.last_upload),
+            'file_count': table.c.file_count + 1,
+            'total_rows': table.c.total_rows + stmt.excluded.total_rows
+        })
+    else:
+        stmt = mysql.insert(table).values(**values)
+        stmt = stmt.on_duplicate_key_update(
+            **{name: stmt.inserted[name] for name in extra},
+            last_upload=func.greatest(func.coalesce(table.c.last_upload, stmt.inserted.last_upload), stmt.inserted.last_upload),
+            file_count=table.c.file_count + 1,
+            total_rows=table.c.total_rows + stmt.inserted.total_rows
+        )
+    db.session.execute(stmt)
+
+# Adds one stored census to the member and union totals, runs in the caller's transaction
+def record_upload(email, union, uploaded_at, rowcount):
+    rows = _rows(rowcount)
+    _upsert(MemberUploadStats, {'email': normalize_email(email)}, {'union': union}, uploaded_at, rows)
+    _upsert(UnionUploadStats, {'union': union}, {}, uploaded_at, rows)
+
+# Recomputes both stats tables from blob_cleaned, used once to backfill when the tables are created
+# Files that never finished their structured load are left out, the same as in the listings
+def rebuild_upload_stats():
+    MemberUploadStats.query.delete()
+    UnionUploadStats.query.delete()
+    rows = func.sum(cast(BlobCleaned.rowcount, Integer))
+    members = db.session.query(BlobCleaned.email, func.max(BlobCleaned.union), func.max(BlobCleaned.uploaded_at), func.count(BlobCleaned.id), rows) \
+        .filter(BlobCleaned.loaded.is_(True)).group_by(BlobCleaned.email).all()
+    merged = {}
+    for email, union, last_upload, file_count, total_rows in members:
+        key = normalize_email(email)
+        if key in merged:
+            previous = merged[key]
+            last_upload = max(filter(None, (previous.last_upload, last_upload)), default=None)
+            previous.last_upload, previous.file_count, previous.total_rows = last_upload, previous.file_count + file_count, previous.total_rows + (total_rows or 0)
+        else:
+            merged[key] = MemberUploadStats(email=key, union=union, last_upload=last_upload, file_count=file_count, total_rows=total_rows or 0)
+    db.session.add_all(merged.values())
+    unions = db.session.query(BlobCleaned.union, func.max(BlobCleaned.uploaded_at), func.count(BlobCleaned.id), rows) \
+        .filter(BlobCleaned.loaded.is_(True)).group_by(BlobCleaned.union).all()
+    db.session.add_all(UnionUploadStats(union=union, last_upload=last_upload, file_count=file_count, total_rows=total_rows or 0) for union, last_upload, file_count, total_rows in unions)
+    db.session.commit()
+
+# Stats for the reporting endpoint
+def upload_stats():
+    unions = UnionUploadStats.query.order_by(UnionUploadStats.union).all()
+    members = MemberUploadStats.query.order_by(MemberUploadStats.union, MemberUploadStats.email).all()
+    return {
+        'unions': [{'union': u.union, 'last_upload': _fmt(u.last_upload), 'file_count': u.file_count, 'total_rows': u.total_rows} for u in unions],
+        'members': [{'email': m.email, 'union': m.union, 'last_upload': _fmt(m.last_upload), 'file_count': m.file_count, 'total_rows': m.total_rows} for m in members]
+    }
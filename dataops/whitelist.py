@@ -0,0 +1,184 @@
+from dbmanager import db
+from .models import InternalUsers, ExternalUsers, WhitelistVersion, normalize_email
+from sqlalchemy import insert, update
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime
+import threading
+import csv
+import io
+import time
+import os
+
+WHITELIST_TTL_SECONDS = float(os.getenv("WHITELIST_TTL_SECONDS", 300))
+# How often a process checks the whitelist version, the longest a change made in another worker can take to apply
+WHITELIST_VERSION_CHECK_SECONDS = float(os.getenv("WHITELIST_VERSION_CHECK_SECONDS", 1))
+
+# email -> (role, expiry), shared by every request in this process
+_roles = {}
+_lock = threading.Lock()
+# Whitelist version the cached roles belong to, and when it was last checked
+_version = {'seen': None, 'checked': 0.0}
+
+def _whitelist_version():
+    return db.session.query(WhitelistVersion.version).filter(WhitelistVersion.id == 1).scalar() or 0
+
+# Drops every cached role when another process has changed the whitelist since the last check
+def _sync_version(now):
+    if now - _version['checked'] < WHITELIST_VERSION_CHECK_SECONDS:
+        return
+    version = _whitelist_version()
+    with _lock:
+        if version != _version['seen']:
+            _roles.clear()
+            _version['seen'] = version
+        _version['checked'] = now
+
+# Bumps the shared version on its own connection, so it holds whatever the caller has or hasn't committed
+def _bump_version():
+    table = WhitelistVersion.__table__
+    with db.engine.begin() as conn:
+        if conn.execute(table.update().where(table.c.id == 1).values(version=table.c.version + 1)).rowcount:
+            return
+        try:
+            conn.execute(table.insert().values(id=1, version=1))
+        except IntegrityError:
+            conn.execute(table.update().where(table.c.id == 1).values(version=table.c.version + 1))
+
+# Whitelist lookups, all through the unique email index
+def find_internal_user(email):
+    return InternalUsers.query.filter_by(email=normalize_email(email)).first()
+
+def find_external_user(email):
+    return ExternalUsers.query.filter_by(email=normalize_email(email)).first()
+
+def _lookup_role(email):
+    if InternalUsers.query.with_entities(InternalUsers.id).filter_by(email=email).first():
+        return 'internal'
+    external = ExternalUsers.query.with_entities(ExternalUsers.union).filter_by(email=email).first()
+    if external:
+        return external.union
+    return None
+
+# Role for an email: 'internal', the union name for external users, or None when not whitelisted
+def resolve_role(email):
+    email = normalize_email(email)
+    now = time.monotonic()
+    _sync_version(now)
+    cached = _roles.get(email)
+    if cached and cached[1] > now:
+        return cached[0]
+    role = _lookup_role(email)
+    with _lock:
+        _roles[email] = (role, now + WHITELIST_TTL_SECONDS)
+    return role
+
+# Drops cached roles after a whitelist change, clears everything when no email is given
+# Every other worker clears its whole cache within WHITELIST_VERSION_CHECK_SECONDS through the shared version row
+def invalidate_role(*emails):
+    _bump_version()
+    with _lock:
+        if not emails:
+            _roles.clear()
+        for email in emails:
+            if email:
+                _roles.pop(normalize_email(email), None)
+
+# Whitelist tables the bulk endpoints work on, with the fields each row needs
+BULK_KINDS = {
+    'admins': (InternalUsers, ('first_name', 'last_name')),
+    'union_members': (ExternalUsers, ('first_name', 'last_name', 'union')),
+}
+BULK_OPS = ('add', 'edit', 'delete')
+BULK_MAX_ROWS = 5000
+
+# Rows from a CSV upload, header names are matched case insensitively and op defaults to add
+def parse_bulk_csv(text):
+    reader = csv.DictReader(io.StringIO(text))
+    rows = []
+    for record in reader:
+        row = {str(k).strip().lower().replace(' ', '_'): (v or '').strip() for k, v in record.items() if k}
+        row.setdefault('op', 'add')
+        rows.append(row)
+    return rows
+
+# Checks every row against the batch and the whitelist in one query, returns (report, plan)
+# Each email may appear once per batch, so rows never depend on the order they are applied in
+def validate_bulk(kind, rows):
+    model, fields = BULK_KINDS[kind]
+    report = []
+    for i, row in enumerate(rows, start=1):
+        op = str(row.get('op') or 'add').strip().lower()
+        email = normalize_email(row.get('email') or '')
+        original = normalize_email(row.get('original_email') or '') or (email if op != 'add' else '')
+        report.append({'row': i, 'op': op, 'email': email or original, 'original_email': original, 'status': 'ok', 'message': None,
+                       'values': {f: str(row[f]).strip() for f in fields if row.get(f) not in (None, '')}})
+
+    lookup = {r['email'] for r in report} | {r['original_email'] for r in report}
+    lookup.discard('')
+    existing = dict(db.session.query(model.email, model.id).filter(model.email.in_(lookup)).all()) if lookup else {}
+
+    seen = {}
+    for entry in report:
+        op, email, original = entry['op'], entry['email'], entry['original_email']
+        touched = {email, original} - {''}
+        error = None
+        if op not in BULK_OPS:
+            error = f"Unknown op, use one of: {', '.join(BULK_OPS)}"
+        elif not email:
+            error = "Missing email"
+        elif op == 'add' and len(entry['values']) < len(fields):
+            error = "Missing " + ", ".join(f for f in fields if f not in entry['values'])
+        elif kind == 'admins' and op != 'delete' and '@unionone.com' not in email:
+            error = "Email must end in @unionone.com"
+        elif op == 'add' and email in existing:
+            error = "Email already exists"
+        elif op != 'add' and original not in existing:
+            error = "User not found"
+        elif op == 'edit' and email != original and email in existing:
+            error = "Email already exists"
+        else:
+            clash = next((e for e in touched if e in seen), None)
+            if clash:
+                error = f"{clash} is also in row {seen[clash]}"
+        for e in touched:
+            seen.setdefault(e, entry['row'])
+        if error:
+            entry['status'], entry['message'] = 'error', error
+
+    plan = {'add': [], 'edit': [], 'delete': []}
+    now = datetime.now()
+    for entry in report:
+        if entry['status'] != 'ok':
+            continue
+        if entry['op'] == 'add':
+            plan['add'].append({'email': entry['email'], 'uploaded_at': now, **entry['values']})
+        elif entry['op'] == 'edit':
+            plan['edit'].append({'id': existing[entry['original_email']], 'email': entry['email'], **entry['values']})
+        else:
+            plan['delete'].append(existing[entry['original_email']])
+    return report, plan
+
+# Validates the whole batch and, only when every row passes, applies it in one transaction
+# One multi-row insert, one executemany update by id and one DELETE ... IN, whatever the batch size
+def apply_bulk(kind, rows, dry_run=False):
+    model, _ = BULK_KINDS[kind]
+    report, plan = validate_bulk(kind, rows)
+    failed = sum(1 for entry in report if entry['status'] != 'ok')
+    applied = 0
+    if not failed and not dry_run:
+        try:
+            if plan['add']:
+                db.session.execute(insert(model), plan['add'])
+            if plan['edit']:
+                db.session.execute(update(model), plan['edit'])
+            if plan['delete']:
+                db.session.query(model).filter(model.id.in_(plan['delete'])).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        applied = len(report)
+        invalidate_role(*({entry['email'] for entry in report} | {entry['original_email'] for entry in report}))
+    for entry in report:
+        entry.pop('values')
+    return {'success': not failed, 'applied': applied, 'failed': failed, 'dry_run': dry_run, 'rows': report}
@@ -0,0 +1,47 @@
+'''
+Gunicorn settings for the web portal: gunicorn -c gunicorn.conf.py app:app
+
+Cleaning doesn't run here, it runs in the watcher process (python sftp_watcher.py), so web workers
+only serve requests. gthread workers keep slow downloads and uploads from tying up a whole process.
+'''
+
+import multiprocessing
+import tempfile
+import os
+
+# Workers write their metrics here and /metrics adds them up, so a scrape sees the whole server, not one worker
+os.environ["METRICS_DIR"] = os.getenv("METRICS_DIR") or os.path.join(tempfile.gettempdir(), "census-web-metrics")
+
+bind = os.getenv("WEB_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv("WEB_THREADS", 4))
+worker_class = "gthread"
+# Large uploads and streamed downloads can legitimately take a while
+timeout = int(os.getenv("WEB_TIMEOUT", 120))
+graceful_timeout = 30
+keepalive = 5
+# Recycles workers now and then so per-process caches and fragmentation don't grow forever
+max_requests = int(os.getenv("WEB_MAX_REQUESTS", 2000))
+max_requests_jitter = 200
+accesslog = "-"
+
+# Schema upgrade and whitelist seeding once in the master before workers fork, not once per worker
+# The master's connections are dropped afterwards so workers never share a socket
+def on_starting(server):
+    from app import app, init_db
+    from dbmanager import db
+    # Files from an earlier server would be added to this one's counters
+    folder = os.environ["METRICS_DIR"]
+    for name in os.listdir(folder) if os.path.isdir(folder) else []:
+        if name.startswith("metrics-"):
+            os.remove(os.path.join(folder, name))
+    init_db()
+    with app.app_context():
+        db.engine.dispose()
+
+# Writes whatever audit entries the worker still has buffered and folds its metrics into the retired totals
+def worker_exit(server, worker):
+    from dataops.audit import audit_log
+    from dataops.metrics import retire_metrics
+    audit_log.flush()
+    retire_metrics()
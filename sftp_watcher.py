@@ -1,52 +1,219 @@
+'''
+SFTP folder watcher and census processing jobs, run as its own process next to the web server:
+
+    python sftp_watcher.py                        # watch SFTP_WATCH and run JOB_WORKERS job threads
+    python sftp_watcher.py --no-watch             # extra job runner only, safe to start several
+    python sftp_watcher.py --metrics-port 9101    # pipeline metrics for Prometheus
+    python sftp_watcher.py --archive-every 3600   # move old blobs to ARCHIVE_DIR hourly, on one process only
+
+Nothing here imports app.py, the watcher and its worker processes only need the database.
+'''
+
 from watchdog.observers.polling import PollingObserver
 from watchdog.events import FileSystemEventHandler
-from censuscleaning import load_file, column_map_final, clean_items, remove_dupes
-from dataops.blob import unclean_blob, clean_blob_excel
-import io, os
+from censuscleaning import load_file
+from dotenv import load_dotenv
+from flask import Flask
+from dbmanager.schema import connect_db
+from dataops.blob import unclean_blob
+from dataops.models import BlobOriginal
+from dataops.pipeline import clean_census, store_cleaned, reuse_cleaned, should_stream, stream_clean, CENSUS_FILE_TYPES
+from dataops.metrics import PipelineTimer, record_pipeline, profiled, start_metrics_server
+from dataops.jobs import start_workers, JOB_WORKERS
+from dataops.archive import start_archiver, ARCHIVE_INTERVAL
+from dataops.audit import insert_log, audit_log
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import argparse
+import threading
+import signal
+import hashlib
+import queue
+import time
+import sys
+import os
 
 WATCH_PATH = os.getenv("SFTP_WATCH")
+SFTP_WORKERS = int(os.getenv("SFTP_WORKERS", os.cpu_count() or 1))
+SFTP_BACKLOG = int(os.getenv("SFTP_BACKLOG", 100))
+SFTP_SETTLE_SECONDS = float(os.getenv("SFTP_SETTLE_SECONDS", 2))
+# Checks a file may stay 0 bytes before it is dropped, so empty files don't hold backlog places forever
+SFTP_EMPTY_CHECKS = int(os.getenv("SFTP_EMPTY_CHECKS", 30))
+
+# New paths from the observer, put() blocks the observer once the backlog is full
+_incoming = queue.Queue(maxsize=SFTP_BACKLOG)
+_db_app = None
+
+# Bare Flask app holding just the database connection, built once per process
+def db_app():
+    global _db_app
+    if _db_app is None:
+        load_dotenv()
+        _db_app = Flask(__name__)
+        connect_db(_db_app)
+    return _db_app
+
+def start_observer(path=None):
+    path = path or WATCH_PATH
+    pool = ProcessPoolExecutor(max_workers=SFTP_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    dispatcher = threading.Thread(target=_dispatch_loop, args=(pool,), daemon=True)
+    dispatcher.start()
 
-def start_observer():
     event_handler = UploadHandler()
     observer = PollingObserver()
-    observer.schedule(event_handler, WATCH_PATH, recursive=True)
+    observer.schedule(event_handler, path, recursive=True)
     observer.start()
-    print(f"WATCHING: {WATCH_PATH}")
+    print(f"WATCHING: {path} ({SFTP_WORKERS} workers)")
     observer.join()
     observer.is_alive()
 
-def process_file(path, email="sftp"):
-    from app import app 
-    with app.app_context():
+# Streams the file through sha256 without holding it in memory
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Waits for files to stop growing, has them hashed in the process pool, then hands them to it to process
+def _dispatch_loop(pool):
+    pending = {}
+    in_flight = set()
+    hashed = queue.Queue()
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(SFTP_WORKERS * 2)
+
+    def hashed_done(future, path):
+        slots.release()
+        try:
+            hashed.put((path, future.result()))
+        except Exception as e:
+            print(f"Bad upload: {path}: {e}")
+
+    def finished(future, path, content_hash):
+        with lock:
+            in_flight.discard(content_hash)
+        slots.release()
+        # Workers are separate processes, so their timings come back here to be recorded
+        try:
+            record = future.result()
+        except Exception as e:
+            print(f"Bad upload: {path}: {e}")
+            record = {'source': 'sftp', 'union': os.path.basename(os.path.dirname(path)), 'rows': 0, 'bytes': 0, 'outcome': 'failed', 'stages': {}}
+        if record:
+            record_pipeline(record)
+
+    while True:
+        # Files hashed since the last pass, the same bytes already being processed are skipped
+        while not hashed.empty():
+            path, content_hash = hashed.get()
+            with lock:
+                if content_hash in in_flight:
+                    print(f"Duplicate upload skipped: {path}")
+                    continue
+                in_flight.add(content_hash)
+            slots.acquire()
+            future = pool.submit(process_file, path, "sftp", content_hash)
+            future.add_done_callback(lambda f, p=path, h=content_hash: finished(f, p, h))
+
+        # Pull new paths, only blocking when there is nothing left to settle
+        try:
+            while len(pending) < SFTP_BACKLOG:
+                path = _incoming.get(timeout=SFTP_SETTLE_SECONDS) if not pending else _incoming.get_nowait()
+                pending.setdefault(path, (-1, 0))
+        except queue.Empty:
+            pass
+        if not pending:
+            continue
+        time.sleep(SFTP_SETTLE_SECONDS)
+
+        # A file is ready once its size matches the last check, one still empty after SFTP_EMPTY_CHECKS is dropped
+        for path, (last_size, empty_checks) in list(pending.items()):
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                del pending[path]
+                continue
+            if size == 0:
+                if empty_checks + 1 >= SFTP_EMPTY_CHECKS:
+                    print(f"Empty upload dropped: {path}")
+                    del pending[path]
+                else:
+                    pending[path] = (size, empty_checks + 1)
+                continue
+            if size != last_size:
+                pending[path] = (size, 0)
+                continue
+            del pending[path]
+
+            # Hashing a large file takes a while, so it runs in the pool and the dispatcher keeps settling the rest
+            slots.acquire()
+            future = pool.submit(file_hash, path)
+            future.add_done_callback(lambda f, p=path: hashed_done(f, p))
+
+# Returns the stage timings for the census, or None when it was already processed
+def process_file(path, email="sftp", content_hash=None):
+    with db_app().app_context(), profiled(os.path.basename(path)):
         filename = os.path.basename(path)
         file_type = filename.split('.')[-1].lower()
         label = os.path.basename(os.path.dirname(path))
+        timer = PipelineTimer('sftp', label, os.path.getsize(path))
 
-        df = load_file(file_type, path)
-        with open(path, "rb") as f:
-            file_bytes = f.read()
+        # Same bytes already picked up from this folder means the watcher saw the file twice
+        content_hash = content_hash or file_hash(path)
+        if BlobOriginal.query.filter_by(content_hash=content_hash, union=label, email=email).first():
+            print(f"Already processed: {filename}")
+            return
 
-        unclean_blob(filename, label, email, file_bytes, file_type)
+        with timer.stage('original_insert'):
+            with open(path, "rb") as f:
+                original = unclean_blob(filename, label, email, f, file_type, content_hash)
+        insert_log(email, filename, 'sftp upload')
+        # Pool processes exit without running atexit, so the audit entry is written before returning
+        audit_log.flush()
+        if reuse_cleaned(original):
+            return timer.finish("reused")
 
-        column_mapped_df = column_map_final(df.columns, df)
-        cleaned_df = remove_dupes(clean_items(column_mapped_df))
-
-        output = io.BytesIO()
-        cleaned_df.to_excel(output, index=False, engine='xlsxwriter')
-        cleaned_bytes = output.getvalue()
-        clean_blob_excel(filename, label, email, cleaned_bytes, len(df))
+        if should_stream(file_type, timer.size):
+            stream_clean(path, file_type, filename, label, email, content_hash, timer)
+        else:
+            with timer.stage('load'):
+                df = load_file(file_type, path)
+            cleaned_df = clean_census(df, timer, label)
+            store_cleaned(filename, label, email, cleaned_df, len(df), content_hash, timer)
 
         print(f"Da file: {filename}")
+        return timer.finish()
 
 
 class UploadHandler(FileSystemEventHandler):
     def on_created(self, event):
         if not event.is_directory:
             filename = os.path.basename(event.src_path)
-            if filename.startswith(".") or not filename.lower().endswith(('.csv', '.xlsx', '.xls', '.txt')):
+            if filename.startswith(".") or filename.split('.')[-1].lower() not in CENSUS_FILE_TYPES:
                 return
-            try:
-                print(f"Uploaded: {event.src_path}")
-                process_file(event.src_path)
-            except Exception as e:
-                print(f"Bad upload: {event.src_path}: {e}")
\ No newline at end of file
+            print(f"Uploaded: {event.src_path}")
+            _incoming.put(event.src_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Watches the SFTP folder and runs census processing jobs")
+    parser.add_argument("--path", default=WATCH_PATH)
+    parser.add_argument("--job-workers", type=int, default=JOB_WORKERS)
+    parser.add_argument("--no-watch", action="store_true", help="only run processing jobs")
+    parser.add_argument("--metrics-port", type=int, default=int(os.getenv("WATCHER_METRICS_PORT", 0)))
+    parser.add_argument("--archive-every", type=int, default=ARCHIVE_INTERVAL, help="seconds between moves of old blobs to the archive, 0 for never")
+    args = parser.parse_args()
+
+    # SIGTERM exits normally so buffered audit entries are flushed by the atexit hook
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    app = db_app()
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    if args.job_workers:
+        start_workers(app, args.job_workers)
+    start_archiver(app, args.archive_every)
+    if args.no_watch:
+        threading.Event().wait()
+    else:
+        start_observer(args.path)
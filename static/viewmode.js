@@ -1,87 +1,142 @@
-let sortAscending = true;
+// Files are listed page by page from /api/files, sorting and filtering run on the server
+const rowsPerPage = 10;
+let sortColumn = "uploaded_at";
+let sortOrder = "desc";
+let cursors = [null];
+let currentPage = 0;
+let filterTimer = null;
 
-// Function for filtering by date
-function sortTableByDate() {
-  const table = document.getElementById("fileTable");
-  const tbody = table.querySelector("tbody");
-  const rows = Array.from(tbody.querySelectorAll("tr"));
-  const arrow = document.getElementById("sortArrow");
+function loadFiles() {
+    const params = new URLSearchParams({
+        union: document.getElementById("searchInput").value.trim(),
+        email: document.getElementById("searchEmail").value.trim(),
+        filename: document.getElementById("searchFilename").value.trim(),
+        sort: sortColumn,
+        order: sortOrder,
+        limit: rowsPerPage
+    });
+    if (cursors[currentPage]) params.set("next", cursors[currentPage]);
 
-  rows.sort((a, b) => {
-    const dateA = new Date(a.children[3].textContent.trim());
-    const dateB = new Date(b.children[3].textContent.trim());
-    return sortAscending ? dateA - dateB : dateB - dateA;
-  });
+    fetch(`/api/files?${params}`)
+        .then(res => res.json())
+        .then(data => {
+            renderFiles(data.files || []);
+            cursors[currentPage + 1] = data.next;
+            renderPagination(Boolean(data.next));
+        })
+        .catch(err => console.error("Listing failed:", err));
+}
 
-  rows.forEach(row => tbody.appendChild(row));
-  sortAscending = !sortAscending;
+function renderFiles(files) {
+    const tbody = document.getElementById("tableBody");
+    tbody.innerHTML = "";
+    files.forEach(file => {
+        const row = document.createElement("tr");
+        [file.filename, file.union, file.email, file.upload_date, file.rowcount].forEach(value => {
+            const cell = document.createElement("td");
+            cell.textContent = value;
+            row.appendChild(cell);
+        });
+        row.appendChild(renderQuality(file));
 
-  arrow.textContent = sortAscending ? "▲" : "▼";
-}
+        const actions = document.createElement("td");
+        actions.innerHTML = `
+            <div class="dropdown">
+                <button class="dropdown-toggle">.  .  .</button>
+                <div class="dropdown-menu" style="display: none;">
+                    <a class="drop-download" href="#" onclick="openModal('download', '${file.id}')">Download</a>
+                    <a class="drop-view" href="#" onclick="openModal('view', '${file.id}')">View</a>
+                </div>
+            </div>`;
+        row.appendChild(actions);
 
+        const status = document.createElement("td");
+        const battery = document.createElement("div");
+        battery.className = "battery";
+        battery.dataset.id = file.id;
+        battery.dataset.stage = file.status;
+        battery.onclick = () => openStatusModal(battery.dataset.id, battery.dataset.stage);
+        status.appendChild(battery);
+        row.appendChild(status);
 
-// Functions for filtering by typing
-function filterFilename() {
-  let input = document.getElementById("searchInput").value.toLowerCase();
-  let rows = document.querySelectorAll("#fileTable tbody tr");
+        tbody.appendChild(row);
+        renderBattery(battery);
+    });
+}
 
-  rows.forEach(row => {
-    let filename = row.children[1].textContent.toLowerCase(); 
-    row.style.display = filename.includes(input) ? "" : "none"; 
-  });
-  currentPage = 1;
+// Quality column: OK, or a link to the report when some rows failed the checks
+function renderQuality(file) {
+    const cell = document.createElement("td");
+    if (file.invalid_rows === null || file.invalid_rows === undefined) {
+        cell.textContent = "-";
+    } else if (file.invalid_rows === 0) {
+        cell.textContent = "OK";
+    } else {
+        const link = document.createElement("a");
+        link.href = "#";
+        link.className = "quality-issues";
+        link.textContent = `${file.invalid_rows} rows`;
+        link.onclick = (e) => { e.preventDefault(); openQuality(file.id); };
+        cell.appendChild(link);
+    }
+    return cell;
 }
 
-function filterEmail() {
-  let input = document.getElementById("searchEmail").value.toLowerCase();
-  let rows = document.querySelectorAll("#fileTable tbody tr");
+function renderPagination(hasNext) {
+    const pagination = document.getElementById("pagination");
+    pagination.innerHTML = "";
 
-  rows.forEach(row => {
-    let email = row.children[2].textContent.toLowerCase(); 
-    row.style.display = email.includes(input) ? "" : "none"; 
-  });
-  currentPage = 1;
-}
+    const prev = document.createElement("button");
+    prev.textContent = "‹";
+    prev.disabled = currentPage === 0;
+    prev.onclick = () => { currentPage--; loadFiles(); };
+    pagination.appendChild(prev);
 
-const rowsPerPage = 10;
-let currentPage = 1;
+    const page = document.createElement("button");
+    page.textContent = currentPage + 1;
+    page.className = "active";
+    pagination.appendChild(page);
 
+    const next = document.createElement("button");
+    next.textContent = "›";
+    next.disabled = !hasNext;
+    next.onclick = () => { currentPage++; loadFiles(); };
+    pagination.appendChild(next);
+}
 
-// Paginiateing ggggggg
-function paginateTable() {
-    const rows = document.querySelectorAll("#fileTable tbody tr");
-    const totalRows = rows.length;
-    const totalPages = Math.ceil(totalRows / rowsPerPage);
+function resetPages() {
+    cursors = [null];
+    currentPage = 0;
+}
 
-    rows.forEach((row, index) => {
-        row.style.display = (
-            index >= (currentPage - 1) * rowsPerPage && index < currentPage * rowsPerPage
-        ) ? "" : "none";
+// Function for sorting by a column, clicking the same column again flips the order
+function sortFiles(column) {
+    sortOrder = (column === sortColumn && sortOrder === "desc") ? "asc" : "desc";
+    sortColumn = column;
+    document.querySelectorAll(".sortArrow").forEach(arrow => {
+        arrow.textContent = arrow.dataset.sort === sortColumn ? (sortOrder === "asc" ? "▲" : "▼") : "";
     });
+    resetPages();
+    loadFiles();
+}
 
-    const pagination = document.getElementById("pagination");
-    pagination.innerHTML = "";
-
-    for (let i = 1; i <= totalPages; i++) {
-        const btn = document.createElement("button");
-        btn.textContent = i;
-        btn.className = (i === currentPage) ? "active" : "";
-        btn.onclick = function () {
-            currentPage = i;
-            paginateTable();
-        };
-        pagination.appendChild(btn);
-    }
+// Function for filtering by typing, waits for a pause before asking the server
+function filterFiles() {
+    clearTimeout(filterTimer);
+    filterTimer = setTimeout(() => {
+        resetPages();
+        loadFiles();
+    }, 300);
 }
-window.onload = paginateTable;
+
+window.onload = loadFiles;
 
 
 // Modal actions for viewing/downloading files
-document.querySelectorAll('.dropdown-toggle').forEach(button => {
-    button.addEventListener('click', () => {
-        const dropdown = button.nextElementSibling;
-        dropdown.style.display = 'flex';
-    });
+document.addEventListener('click', (e) => {
+    if (e.target.classList.contains('dropdown-toggle')) {
+        e.target.nextElementSibling.style.display = 'flex';
+    }
 });
 
 window.addEventListener('click', (e) => {
@@ -104,16 +159,69 @@ function openModal(action, fileId = null) {
         document.getElementById('modalDownload').style.display = 'flex';
     } else {
         document.getElementById('modalPreview').style.display = 'flex';
-        document.getElementById('previewTable').innerHTML = `<p style="display: flex;font-family: 'Inter', 'Segoe UI', sans-serif;font-weight: 500;";>Loading Preview...</p>`;
-        fetch(`/preview/${fileId}`)
-            .then(res => res.text())
-            .then(html => {document.getElementById('previewTable').innerHTML = html})
-            .catch(err => {
-                document.getElementById('previewTable').innerHTML = `<p style="display: flex;font-family: 'Inter', 'Segoe UI', sans-serif;font-weight: 500;color:red";>Failed to load preview</p>`
-                console.error(err)
-            })
+        loadPreview(fileId, 1);
     }
 }
+
+// Preview pages are served from the stored preview rows
+function loadPreview(fileId, page) {
+    const pager = document.getElementById('previewPager');
+    pager.innerHTML = "";
+    document.getElementById('previewTable').innerHTML = `<p style="display: flex;font-family: 'Inter', 'Segoe UI', sans-serif;font-weight: 500;";>Loading Preview...</p>`;
+    fetch(`/preview/${fileId}?page=${page}`)
+        .then(async res => {
+            const html = await res.text();
+            document.getElementById('previewTable').innerHTML = html;
+            const current = parseInt(res.headers.get('X-Preview-Page') || "1");
+            const pages = parseInt(res.headers.get('X-Preview-Pages') || "1");
+            for (let i = 1; i <= pages; i++) {
+                const btn = document.createElement("button");
+                btn.textContent = i;
+                btn.className = (i === current) ? "active" : "";
+                btn.onclick = () => loadPreview(fileId, i);
+                pager.appendChild(btn);
+            }
+        })
+        .catch(err => {
+            document.getElementById('previewTable').innerHTML = `<p style="display: flex;font-family: 'Inter', 'Segoe UI', sans-serif;font-weight: 500;color:red";>Failed to load preview</p>`
+            console.error(err)
+        })
+}
+// Per-field quality report for one file
+function openQuality(fileId) {
+    const body = document.getElementById('qualityTable');
+    body.innerHTML = `<p style="display: flex;font-family: 'Inter', 'Segoe UI', sans-serif;font-weight: 500;";>Loading Report...</p>`;
+    document.getElementById('modalQuality').style.display = 'flex';
+    fetch(`/api/files/${fileId}/quality`)
+        .then(res => res.json())
+        .then(report => {
+            const table = document.createElement("table");
+            table.className = "preview_table";
+            table.innerHTML = "<thead><tr><th>Field</th><th>Missing</th><th>Invalid</th><th>Examples</th></tr></thead>";
+            const rows = document.createElement("tbody");
+            Object.entries(report.fields || {}).forEach(([field, counts]) => {
+                const row = document.createElement("tr");
+                const examples = counts.samples.map(s => `row ${s.row}: ${s.value}`).join(", ");
+                [field, counts.missing, counts.invalid, examples].forEach(value => {
+                    const cell = document.createElement("td");
+                    cell.textContent = value;
+                    row.appendChild(cell);
+                });
+                rows.appendChild(row);
+            });
+            table.appendChild(rows);
+            body.innerHTML = `<p>${report.invalid_rows} of ${report.rows} rows have at least one problem</p>`;
+            body.appendChild(table);
+        })
+        .catch(err => {
+            body.innerHTML = `<p style="display: flex;font-family: 'Inter', 'Segoe UI', sans-serif;font-weight: 500;color:red";>Failed to load report</p>`
+            console.error(err)
+        })
+}
+document.getElementById('closeQuality').addEventListener("click", () => {
+    document.getElementById('modalQuality').style.display = 'none';
+});
+
 let currentFileId = null; 
 document.getElementById('submitRow').addEventListener("click", () => {
     if (currentFileId !== null) {
@@ -0,0 +1,31 @@
+import pandas as pd
+
+from dataops.mapping import learn_mapping, apply_mapping
+
+
+def test_learns_columns_copied_from_one_raw_column():
+    df = pd.DataFrame({'First Name': ['Ann', 'Bo'], 'EMAIL': ['a@x.com', 'b@x.com']})
+    mapped = pd.DataFrame({'first_name': df['First Name'], 'email': df['EMAIL']})
+    mapping = learn_mapping(df, mapped)
+    assert mapping == {'first_name': 'First Name', 'email': 'EMAIL'}
+    pd.testing.assert_frame_equal(apply_mapping(df, mapping), mapped)
+
+
+# A blank standard column must not be tied to an empty raw column, next month's notes would land in phone
+def test_blank_target_matching_one_empty_raw_column_is_not_reusable():
+    df = pd.DataFrame({'First Name': ['Ann', 'Bo'], 'Notes': [None, None]})
+    mapped = pd.DataFrame({'first_name': df['First Name'], 'phone': pd.Series([None, None], dtype=object)})
+    assert learn_mapping(df, mapped) is None
+
+
+# Apt was empty this month, storing phone/apt as blank for good would drop it from every later file
+def test_blank_target_with_several_empty_raw_columns_is_not_reusable():
+    df = pd.DataFrame({'First Name': ['Ann', 'Bo'], 'Apt': [None, None], 'Notes': [None, None]})
+    mapped = pd.DataFrame({'first_name': df['First Name'], 'apt': df['Apt']})
+    assert learn_mapping(df, mapped) is None
+
+
+def test_target_matching_several_raw_columns_is_not_reusable():
+    df = pd.DataFrame({'Email': ['a@x.com', 'b@x.com'], 'Email Address': ['a@x.com', 'b@x.com']})
+    mapped = pd.DataFrame({'email': df['Email']})
+    assert learn_mapping(df, mapped) is None